@@ -0,0 +1,429 @@
+"""
+This script measures a full run of wiki-ranking.py without touching any real wiki.
+
+Wikis are answered by a local stand-in for Wikia's api.php (siteinfo, allusers and usercontribs) and the central
+Wikis/Details API,
+list, talk, ranking and column pages are served from generated fixtures and the bot runs in simulate mode.
+Every list size is measured in a separate process, so peak memory is reported per size.
+
+==  List of accepted arguments  =====
+
+-sizes:N,N,...          List sizes to measure (default: 100,1000,10000,50000)
+
+-categories:N           Number of categories on the list (default: 20)
+
+-latency:MS             Latency of every mock API response in milliseconds (default: 0)
+
+-jitter:MS              Random extra latency added to every response in milliseconds (default: 0)
+
+-errors:RATE            Part of API responses answered with "503 Service Unavailable" (default: 0)
+
+-closed:RATE            Part of wikis reported as closed (default: 0)
+
+==  FLAGS  ==========================
+
+-save             Let the bot save pages (into fixtures) instead of running in simulate mode
+
+-warm             Run the bot once to fill its cache first and measure the next run, made after counts
+                  and admins expired (wiki info, ids and stored responses are still valid)
+                  eg. -warm -stats:central compared with -warm -stats:siteinfo
+
+-verbose          Show the bot's output
+
+Any other argument is passed to wiki-ranking.py (eg. -workers:20 or -nocache).
+
+==  Output  =========================
+
+One row per list size: wall time, time of each phase, number of requests per API endpoint (and of "304 Not Modified" answers),
+number of fixture page reads/saves and peak memory (RSS) of the process.
+
+"""
+#
+# Distributed under the terms of the CC-BY-NC 3.0 license.
+# License summary: http://creativecommons.org/licenses/by-nc/3.0/
+# Full legal code: http://creativecommons.org/licenses/by-nc/3.0/legalcode
+#
+#
+
+import sys, os, time, json, random, datetime, hashlib, zlib, sqlite3
+import threading, urlparse, subprocess, tempfile, shutil, resource, imp
+import BaseHTTPServer, SocketServer
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wiki-ranking.py')
+
+settings = {
+    'sizes': [100, 1000, 10000, 50000],
+    'size': None,
+    'categories': 20,
+    'latency': 0,
+    'jitter': 0,
+    'errors': 0,
+    'closed': 0,
+    'save': False,
+    'warm': False,
+    'verbose': False,
+    'bot_args': [],
+}
+
+phases = ['initialize', 'preprocess_list', 'process_list_talk', 'process_list', 'start_rankings', 'run_put_queue']
+
+# Config served from MediaWiki:Ranking-bot-settings
+bench_config = {
+    'languages': ['pl'],
+    'pages': {
+        'list': 'Lista wiki',
+        'list_column': 'Lista wiki/Kolumna',
+        'list_cat_column': 'Lista wiki/Kolumna kategorii',
+        'ranking_main_article': 'Ranking/Artykuly',
+        'ranking_main_image': 'Ranking/Obrazy',
+        'ranking_category_article': 'Ranking/Artykuly/%s',
+        'ranking_category_image': 'Ranking/Obrazy/%s',
+    },
+    'limits': {
+        'main_article': 100,
+        'main_image': 50,
+        'category_article': 10,
+        'category_image': 5,
+    },
+    'templates': {
+        'list_record': ['Wiki', 'name=%(name)s', 'display=%(display)s', 'code=%(code)s', 'address=%(address)s', 'categories=%(categories)s', 'articles=%(articles)s', 'images=%(images)s', 'users=%(users)s', 'admins=%(admins)s'],
+        'category_record': ['Kategoria', 'name=%(name)s', 'articles=%(articles)s', 'artcount=%(artcount)s', 'images=%(images)s', 'imgcount=%(imgcount)s'],
+        'column': ['Kolumna'],
+        'ranking_record': ['Ranking', '%(place)s', '%(move)s', '%(code)s', '%(name)s', '%(count)s'],
+    },
+    'tags': {
+        'ranking_columns': [['<!-- COLUMN 1 -->', '<!-- /COLUMN 1 -->'], ['<!-- COLUMN 2 -->', '<!-- /COLUMN 2 -->']],
+        'list': ['<!-- LIST -->', '<!-- /LIST -->'],
+        'talk': ['<!-- QUEUE -->', '<!-- /QUEUE -->'],
+        'categories': ['<!-- CATEGORIES -->', '<!-- /CATEGORIES -->'],
+    },
+    'msg': {},
+    'allowed_groups': ['sysop', 'bot'],
+    'allowed_users': [],
+    'admin_active_days': 60,
+    'edit_restriction': {
+        'list': {'once': 'a day', 'days': [1, 2, 3, 4, 5, 6, 7]},
+        'ranking': {'once': 'a day', 'days': [1, 2, 3, 4, 5, 6, 7]},
+    },
+}
+
+def wiki_data(code):
+    # Same code always gives the same wiki
+    rnd = random.Random(code)
+    admins = rnd.randint(1, 40)
+    return {
+        'articles': int(rnd.paretovariate(0.8) * 20),
+        'images': int(rnd.paretovariate(0.9) * 5),
+        'activeusers': rnd.choice([0, 0, 1, 2, 5, 20, 100]),
+        'admins': ['Admin %d' % x for x in range(admins)],
+        'active': set(['Admin %d' % x for x in range(admins) if rnd.random() < 0.3]),
+        'categories': rnd.sample(range(settings['categories']), min(settings['categories'], rnd.choice([0, 1, 1, 2, 3]))),
+        'edited': rnd.random() < 0.2,
+    }
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Whole response in one write - unbuffered headers run into Nagle's algorithm on keep-alive connections
+    wbufsize = -1
+    def log_message(self, *a): pass
+    def send_body(self, status, body, headers = {}):
+        self.send_response(status)
+        for key in headers: self.send_header(key, headers[key])
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def do_GET(self):
+        # Requests come through the bot's proxy setting, so path is an absolute URL
+        url = urlparse.urlsplit(self.path)
+        host = url.netloc or self.headers.get('host', '')
+        code = host.split('.wikia.com')[0]
+        if code.startswith('www.'): code = code[4:]
+        params = dict(urlparse.parse_qsl(url.query))
+        endpoint = params.get('list') or params.get('meta') or 'other'
+        if url.path.endswith('/Wikis/Details'): endpoint = 'details'
+        self.server.count(endpoint)
+
+        delay = settings['latency'] + random.uniform(0, settings['jitter'])
+        if delay: time.sleep(delay / 1000.0)
+        if random.random() < settings['errors']:
+            return self.send_body(503, 'Service Unavailable', {'Retry-After': '0'})
+        if endpoint == 'details':
+            # Closed wikis are left out, like ones that don't exist
+            items = {}
+            for city_id in params.get('ids', '').split(','):
+                code = self.server.codes.get(int(city_id))
+                if code == None or random.Random('closed' + code).random() < settings['closed']: continue
+                data = wiki_data(code)
+                items[city_id] = {'id': int(city_id), 'url': 'http://%s.wikia.com/' % code, 'stats': {'articles': data['articles'], 'images': data['images'], 'activeUsers': data['activeusers']}}
+            return self.send_body(200, json.dumps({'items': items}), {'Content-Type': 'application/json'})
+        if random.Random('closed' + code).random() < settings['closed']:
+            return self.send_body(200, '<html><body class="page-Special_CloseWiki">Closed</body></html>')
+
+        data = wiki_data(code)
+        if endpoint == 'siteinfo':
+            city_id = zlib.crc32(code) & 0x7fffffff
+            with self.server.lock: self.server.codes[city_id] = code
+            result = {'query': {
+                'general': {
+                    'sitename': 'Wiki %s' % code,
+                    'server': 'http://%s.wikia.com' % code,
+                    'lang': 'pl',
+                    # Database name, like wfWikiID() - the central API takes wgCityId
+                    'wikiid': code,
+                    'time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                },
+                'statistics': {
+                    'articles': data['articles'],
+                    'images': data['images'],
+                    'activeusers': data['activeusers'],
+                },
+            }}
+            if 'variables' in params.get('siprop', '').split('|'):
+                result['query']['variables'] = [{'id': 'wgCityId', '*': str(city_id)}, {'id': 'wgDBname', '*': code}]
+        elif endpoint == 'allusers':
+            limit = params.get('aulimit', '10')
+            if limit == 'max': limit = 500
+            limit = int(limit)
+            names = sorted([x for x in data['admins'] if x >= params.get('aufrom', '')])
+            result = {'query': {'allusers': [{'name': x, 'editcount': 10} for x in names[:limit]]}}
+            if len(names) > limit: result['query-continue'] = {'allusers': {'aufrom': names[limit]}}
+        elif endpoint == 'usercontribs':
+            now = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+            users = params.get('ucuser', '').split('|')
+            result = {'query': {'usercontribs': [{'user': x, 'timestamp': now} for x in users if x in data['active']]}}
+        elif endpoint == 'recentchanges':
+            # About a fifth of wikis is edited all the time, the rest hasn't changed in a while
+            if data['edited']: changed = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+            else: changed = '2000-01-01T00:00:00Z'
+            result = {'query': {'recentchanges': [{'type': 'edit', 'timestamp': changed}]}}
+        else:
+            result = {'error': {'code': 'unknown'}}
+        body = json.dumps(result)
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('if-none-match') == etag:
+            self.server.count('not modified')
+            return self.send_body(304, '', {'ETag': etag})
+        self.send_body(200, body, {'Content-Type': 'application/json', 'ETag': etag})
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), MockHandler)
+        self.lock = threading.Lock()
+        self.requests = {}
+        # Wiki ids given out in siteinfo - {id: code}
+        self.codes = {}
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+def render(template, rec):
+    # Same output as prepare_template in wiki-ranking.py
+    template = bench_config['templates'][template]
+    unnamed = [x for x in template[1:] if x.find('=') == -1]
+    named = [x for x in template[1:] if x.find('=') != -1]
+    unnamed = unnamed and ' | ' + ' | '.join(unnamed) + ' ' or ''
+    named = named and '\n| ' + '\n| '.join(named) + '\n' or ''
+    return ('{{%s%s%s}}' % (template[0], unnamed, named)) % rec
+def fixture_pages(size):
+    tags = bench_config['tags']
+    pages = {}
+    cats = ['Kategoria %d' % x for x in range(settings['categories'])]
+
+    records = []
+    ranking = []
+    for x in range(size):
+        code = 'bench%d' % x
+        data = wiki_data(code)
+        records.append(render('list_record', {
+            'name': 'Wiki %s' % code,
+            'display': '',
+            'code': code,
+            'address': 'http://%s.wikia.com/' % code,
+            'categories': ', '.join([cats[c] for c in data['categories']]),
+            'articles': data['articles'],
+            'images': data['images'],
+            'users': data['activeusers'],
+            'admins': len(data['active']),
+        }))
+        if data['activeusers'] and data['articles'] >= bench_config['limits']['main_article']:
+            ranking.append((data['articles'], code))
+    categories = [render('category_record', {'name': x, 'articles': 0, 'artcount': 0, 'images': 0, 'imgcount': 0}) for x in cats]
+    pages['Lista wiki'] = 'Lista\n%s\n%s\n%s\n%s\n%s\n%s\n' % (tags['categories'][0], '\n'.join(categories), tags['categories'][1], tags['list'][0], '\n'.join(records), tags['list'][1])
+
+    queue = ['* [[w:c:new%d|New wiki %d]] - %s' % (x, x, cats[x % len(cats)] if cats else '') for x in range(max(1, size / 100))]
+    lazies = ' '.join(['http://lazy%d.wikia.com/wiki/Main' % x for x in range(max(1, size / 200))])
+    pages['Dyskusja:Lista wiki'] = 'Prosby\n%s\n%s\n%s\nInne linki: %s\n' % (tags['talk'][0], '\n'.join(queue), tags['talk'][1], lazies)
+
+    ranking.sort(reverse = True)
+    old = [render('ranking_record', {'place': x + 1, 'move': '//', 'code': code, 'name': 'Wiki %s' % code, 'count': count}) for x, (count, code) in enumerate(ranking)]
+    columns = ''.join(['%s\n%s\n%s\n' % (tag[0], '\n'.join(old[i::2]), tag[1]) for i, tag in enumerate(tags['ranking_columns'])])
+    ranking_text = 'Ranking <span id="data">-</span> <span id="licznik">0</span>\n%s' % columns
+    pages[bench_config['pages']['ranking_main_article']] = ranking_text
+    pages[bench_config['pages']['ranking_main_image']] = ranking_text
+    for cat in cats:
+        pages[bench_config['pages']['ranking_category_article'] % cat.lower()] = ranking_text
+        pages[bench_config['pages']['ranking_category_image'] % cat.lower()] = ranking_text
+
+    pages[bench_config['pages']['list_column']] = '<onlyinclude></onlyinclude>'
+    pages[bench_config['pages']['list_cat_column']] = '<onlyinclude></onlyinclude>'
+    pages['MediaWiki:Ranking-bot-settings'] = '<pre>%s</pre>' % json.dumps(bench_config)
+    return pages
+
+class FixtureFamily(object):
+    langs = {'pl': 'localhost'}
+    def server_time(self, lang):
+        return datetime.datetime.utcnow()
+class FixtureSite(object):
+    family = FixtureFamily()
+    def __init__(self, pages):
+        self.pages = pages
+        self.lock = threading.Lock()
+        self.reads = 0
+        self.saves = 0
+        self.queries = 0
+class FixturePage(object):
+    def __init__(self, site, title):
+        self.site = site
+        self.name = title
+    def title(self):
+        return self.name
+    def exists(self):
+        return self.name in self.site.pages
+    def toggleTalkPage(self):
+        if self.name.startswith('Dyskusja:'): return FixturePage(self.site, self.name[9:])
+        return FixturePage(self.site, 'Dyskusja:' + self.name)
+    def permalink(self):
+        return self.name
+    def latestRevision(self):
+        return 1
+    def getOldVersion(self, revid):
+        with self.site.lock: self.site.reads += 1
+        return self.site.pages[self.name]
+    def get(self, force = False):
+        return self.getOldVersion(1)
+    def put(self, text, comment = None):
+        with self.site.lock:
+            self.site.saves += 1
+            self.site.pages[self.name] = text
+def fixture_query(site):
+    def GetData(params, s = None):
+        with site.lock: site.queries += 1
+        if params.get('prop') == 'revisions' and 'content' in params['rvprop']:
+            pages = {}
+            for i, title in enumerate(params['titles'].split('|')):
+                if title not in site.pages: pages[str(-i-1)] = {'title': title, 'missing': ''}
+                else: pages[str(i+1)] = {'title': title, 'revisions': [{'revid': 1, 'timestamp': '2000-01-01T00:00:00Z', '*': site.pages[title]}]}
+            return {'query': {'pages': pages}}
+        if params.get('prop') == 'revisions':
+            return {'query': {'pages': {'1': {'revisions': [{'revid': 1, 'timestamp': '2000-01-01T00:00:00Z', 'user': 'Bench', 'comment': ''}]}}}}
+        if params.get('list') == 'users':
+            return {'query': {'users': [{'name': x, 'groups': ['sysop']} for x in params['ususers'].split('|')]}}
+        return {}
+    return GetData
+
+def load_bot():
+    # wiki-ranking.py can't be imported by name, and has no source encoding declared
+    bot = imp.new_module('wiki_ranking')
+    bot.__file__ = script
+    source = open(script).read()
+    exec compile(source, script, 'exec') in bot.__dict__
+    return bot
+def run_bot(server, site, tmp):
+    # Fresh copy of the bot every time - it keeps its state in globals
+    bot = load_bot()
+    times = {}
+    def timed(name, func):
+        def wrapper(*a, **k):
+            start = time.time()
+            try: return func(*a, **k)
+            finally: times[name] = times.get(name, 0) + time.time() - start
+        return wrapper
+    for name in phases: setattr(bot, name, timed(name, getattr(bot, name)))
+
+    pywikibot = bot.pywikibot
+    pywikibot.simulate = not settings['save']
+    pywikibot.getSite = lambda *a, **k: site
+    pywikibot.Page = FixturePage
+    pywikibot.handleArgs = lambda: ['-forcelist', '-forceranking', '-cache:%s' % os.path.join(tmp, 'cache'), '-archive:%s' % os.path.join(tmp, 'archive'), '-snapshot:%s' % os.path.join(tmp, 'snapshot.json.gz'), '-state:%s' % os.path.join(tmp, 'state.json')] + settings['bot_args']
+    bot.query.GetData = fixture_query(site)
+    bot.http_settings['proxy'] = '127.0.0.1:%d' % server.server_address[1]
+    bot.show_diff = timed('show_diff', bot.show_diff)
+    if not settings['verbose']: pywikibot.output = lambda *a, **k: None
+
+    start = time.time()
+    try:
+        bot.main()
+    except SystemExit, e:
+        times['exit'] = e.code
+    return time.time() - start, times
+def expire_counts(tmp):
+    # Same as the next day's run: counts and admins are out of date, the rest of the cache is not
+    db = sqlite3.connect(os.path.join(tmp, 'cache', 'json.sqlite'))
+    db.execute("UPDATE cache SET fetched = 0 WHERE kind IN ('stats', 'admins', 'active', 'changes')")
+    db.commit()
+    db.close()
+def run_size(size):
+    server = MockServer()
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    site = FixtureSite(fixture_pages(size))
+    tmp = tempfile.mkdtemp(prefix = 'ranking-bench-')
+    if settings['warm']:
+        run_bot(server, site, tmp)
+        expire_counts(tmp)
+        server.requests = {}
+        site.reads = site.saves = site.queries = 0
+    wall, times = run_bot(server, site, tmp)
+
+    server.shutdown()
+    shutil.rmtree(tmp, True)
+    return {
+        'size': size,
+        'wall': wall,
+        'phases': times,
+        'requests': server.requests,
+        'page_reads': site.reads,
+        'page_saves': site.saves,
+        'queries': site.queries,
+        'peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+def run_all():
+    results = []
+    for size in settings['sizes']:
+        args = [sys.executable, os.path.abspath(__file__), '-size:%d' % size] + [x for x in sys.argv[1:] if not x.startswith('-sizes:')]
+        output = subprocess.check_output(args)
+        results.append(json.loads(output.strip().split('\n')[-1]))
+        report(results[-1])
+    return results
+def report(result):
+    phase_times = ', '.join(['%s %.2fs' % (name, result['phases'][name]) for name in phases + ['show_diff'] if name in result['phases']])
+    requests = ', '.join(['%s %d' % (name, result['requests'][name]) for name in sorted(result['requests'])])
+    print '%6d wikis: %8.2fs  peak %7.1f MB  requests: %s (total %d)  pages: %d read, %d saved, %d queries' % (result['size'], result['wall'], result['peak_mb'], requests or '-', sum([result['requests'][x] for x in result['requests'] if x != 'not modified']), result['page_reads'], result['page_saves'], result['queries'])
+    print '              %s' % phase_times
+    if 'exit' in result['phases']: print '              exit code: %s' % result['phases']['exit']
+
+def main():
+    for arg in sys.argv[1:]:
+        if   arg.startswith('-sizes:'):      settings['sizes'] = [int(x) for x in arg[7:].split(',')]
+        elif arg.startswith('-size:'):       settings['size'] = int(arg[6:])
+        elif arg.startswith('-categories:'): settings['categories'] = int(arg[12:])
+        elif arg.startswith('-latency:'):    settings['latency'] = float(arg[9:])
+        elif arg.startswith('-jitter:'):     settings['jitter'] = float(arg[8:])
+        elif arg.startswith('-errors:'):     settings['errors'] = float(arg[8:])
+        elif arg.startswith('-closed:'):     settings['closed'] = float(arg[8:])
+        elif arg == '-save':                 settings['save'] = True
+        elif arg == '-warm':                 settings['warm'] = True
+        elif arg == '-verbose':              settings['verbose'] = True
+        else:                                settings['bot_args'].append(arg)
+
+    if settings['size'] == None:
+        run_all()
+        return
+    result = run_size(settings['size'])
+    sys.stdout.flush()
+    print json.dumps(result)
+
+if __name__ == "__main__":
+    main()
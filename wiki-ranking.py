@@ -12,6 +12,50 @@ This script is used to update rankings and list with latest article and image co
 -revisionday:YYYY-MM-DD     Use revision made on that day as a reference for changes on wiki rankings
                             (or next one right after that date)
 
+-workers:N                  Number of wikis fetched at once while processing the list (default: 10)
+
+-putthrottle:N              Minimum number of seconds between page saves
+
+-maxlag:N                   Maximum server lag (in seconds) accepted when saving pages
+
+-cache:directory            Directory for the persistent JSON cache (default: cache)
+
+-archive:directory          Directory for daily snapshots of saved rankings (default: archive)
+                            Snapshots are used instead of ranking pages' history for changes in rankings
+
+-profile:filename           Save a JSON report of the run (default: profile.json): wall and CPU time of every phase,
+                            number and latency histograms of requests per API endpoint and time spent in parsing helpers
+
+-cprofile:filename          Save cProfile stats of the main thread (default: profile.pstats)
+
+-stats:backend              Source of article, image and active user counts (default: siteinfo)
+                            siteinfo - one request per wiki, central - many wikis per request from central host
+                            (wikis without known id or missing from its answer are fetched from siteinfo)
+
+-fullrefresh:N              With -incremental every wiki is fetched in full at least once every N runs (default: 4)
+
+-shard:i/N                  Only fetch stats of the i-th of N parts of the list (counted from 1) and save them
+                            to a shard file - pages aren't changed. Wikis are split by their code, so shards
+                            can be collected by separate processes or machines from the same list
+
+-shards:directory           Directory of shard files (default: shards)
+
+-shardage:N                 With -merge shards older than N hours are ignored (default: 24)
+
+-state:filename             File with time of the last save of every page made by the bot (default: state.json)
+                            Edit restrictions are checked against it before reading page history
+
+-snapshot:filename          File the stats of all wikis on the list are saved to after fetching them (default: snapshot.json.gz)
+
+-offline:filename           Render the list, its columns and rankings from stats snapshot saved earlier (default: snapshot.json.gz)
+                            instead of fetching stats - talk page isn't processed
+
+-diffcontext:N              Lines of context around changes shown in simulation mode (default: 3)
+
+-difflines:N                Maximum number of difference lines shown per page in simulation mode (default: 100)
+
+-difffile:filename          Save whole differences of all pages in simulation mode as unified diff (default: simulate.diff)
+
 ==  FLAGS  ==========================
 
 -forcelist        Ignore edit restriction for list
@@ -29,6 +73,25 @@ This script is used to update rankings and list with latest article and image co
 
 -simulate         Just a reminder it's usefull here ;)
 
+-nocache          Don't read or write the persistent JSON cache (in-memory cache is still used)
+
+-noarchive        Don't read or write ranking snapshots
+
+-nosnapshot       Don't save stats snapshot
+
+-nostate          Don't read or write the run state file
+
+-stale            Use expired entries from the persistent JSON cache right away
+                  and refresh them in the background for the next run
+
+-merge            Use stats from shard files and update the list and rankings as usual
+                  Wikis missing from shards (eg. new ones) are fetched as usual
+                  Only shards of one split (N), made from the same list revision are used
+                  and they're renamed to *.merged once all pages are saved
+
+-incremental      Fetch stats and admins only for wikis with new recent changes since their last fetch
+                  and reuse previous counts for the rest (needs the persistent JSON cache)
+
 ==  Exit codes  =====================
 
 0       On success
@@ -41,6 +104,8 @@ This script is used to update rankings and list with latest article and image co
 
 4       Edit restricted
 
+5       Invalid arguments
+
 100     On KeyboardInterrupt
 
 """
@@ -52,9 +117,17 @@ This script is used to update rankings and list with latest article and image co
 #
 
 import wikipedia as pywikibot
-import userlib
+import query
 import sys, re, datetime
 import urllib2, json, codecs
+import threading, Queue, itertools
+import os, time, sqlite3, gzip
+import httplib, urlparse, socket, zlib, random, collections
+import contextlib, cProfile, difflib, bisect
+try: import resource
+except ImportError: resource = None # Not available on Windows - peak memory isn't reported there
+# datetime.strptime imports it lazily, which isn't thread safe - and workers parse timestamps
+import _strptime
 
 # Set this and it'll work on that wiki regardles of what wiki is set as default in user-config.py
 # You can still override this with -family and -lang switches
@@ -62,6 +135,30 @@ import urllib2, json, codecs
 force_family = 'community'
 force_lang = 'pl'
 
+# Settings of the HTTP client used for all JSON requests sent to wikis
+# Timeouts and backoff are in seconds, connections is the number of kept-alive hosts per worker
+# proxy is "host:port" of an HTTP proxy used for plain HTTP requests (None - connect directly)
+http_settings = {
+    'connect_timeout': 10,
+    'read_timeout': 60,
+    'tries': 5,
+    'backoff': 1,
+    'max_backoff': 60,
+    'maxlag': 5,
+    'connections': 4,
+    'proxy': None,
+}
+
+# Source of article, image and active user counts (-stats switch overrides backend)
+# siteinfo - one siteinfo request per wiki
+# central - counts of up to batch wikis per request from Wikis/Details API on central_host,
+#           wikis are looked up by city ids (wgCityId) saved from their siteinfo and the rest falls back to siteinfo
+stats_settings = {
+    'backend': 'siteinfo',
+    'central_host': 'www.wikia.com',
+    'batch': 100,
+}
+
 # And rest of the config is stored on the wiki
 # Mediawiki:Ranking-bot-pages
 
@@ -97,6 +194,16 @@ config = {
     'allowed_groups': [],
     'allowed_users': [],
     'admin_active_days': 60,
+    'cache_ttl': {
+        'info': 604800,
+        'stats': 21600,
+        'admins': 21600,
+        'active': 21600,
+        'rights': 3600,
+        'changes': 2592000,
+        'responses': 2592000,
+        'ids': 2592000,
+    },
     'edit_restriction': {
         'list': {
             'once': None,
@@ -117,6 +224,7 @@ def exit(key):
         'NoList': 2,
         'OutOfRevisions': 3,
         'EditRestricted': 4,
+        'InvalidArgs': 5,
         'KeyboardInterrupt': 100,
     }[key]
     try:
@@ -127,18 +235,31 @@ def exit(key):
     sys.exit(code)
     return code
 def main():
-    initialize()
-    global site, config, args
+    global site, config, args, profiler, shard_results
+    profiler = Profiler()
+    with profiler.phase('initialize'): initialize()
+    cprofile = None
+    if args['cprofile']:
+        cprofile = cProfile.Profile()
+        cprofile.enable()
     
     if args['extended']: pywikibot.output('\n\03{lightgreen}=================================================== \03{lightyellow} Initialization COMPLETE \03{lightgreen} ====================================================\03{default}')
     
     list = pywikibot.Page(site, config['pages']['list'])
     listtalk = list.toggleTalkPage()
+    # Rankings and columns are preloaded once stats are fetched (see process_list) - they're spliced right after that
+    with profiler.phase('preload_pages'): page_store.preload([list, listtalk])
     
-    if not list.exists():
+    if not page_exists(list):
         pywikibot.output('\n\n\03{lightred}FATAL ERROR:\03{default} List page (\03{lightaqua}%s\03{default}) does not exits.' % list.title())
         return exit('NoList')
     
+    if args['shard']:
+        # Shards only collect stats - the list, its talk page and rankings are left for -merge
+        with profiler.phase('preprocess_list'): preprocess_list(list)
+        with profiler.phase('collect_shard'): collect_shard()
+        return finish(cprofile)
+    
     if args['forcelist']: list_restriction = True
     else: list_restriction = check_edit_restriction(list, 'list')
     
@@ -149,30 +270,48 @@ def main():
         else:
             return exit('EditRestricted')
     
-    preprocess_list(list)
-    process_list_talk(listtalk)
-    process_list(list)
+    with profiler.phase('preprocess_list'): preprocess_list(list)
+    # Shards are checked against the list revision read above
+    if args['merge']: shard_results = load_shards(args['shards'])
+    # New wikis from the talk page would need their stats fetched - they're left for the next online run
+    if not args['offline']:
+        with profiler.phase('process_list_talk'): process_list_talk(listtalk)
+    with profiler.phase('process_list'): process_list(list)
     if args['extended']: pywikibot.output('\n\03{lightgreen}=========================================================== \03{lightyellow} List DONE \03{lightgreen} ===========================================================\03{default}')
     start_rankings()
     if args['extended']: pywikibot.output('\n\03{lightgreen}========================================================= \03{lightyellow} Rankings DONE \03{lightgreen} =========================================================\03{default}')
     
-    run_put_queue()
+    with profiler.phase('run_put_queue'): saved = run_put_queue()
+    if args['merge'] and saved and not pywikibot.simulate: retire_shards()
+    finish(cprofile)
+def finish(cprofile = None):
+    global args, profiler
+    json_cache.close()
+    pool.close()
+    save_pool.close()
+    
+    if cprofile != None:
+        cprofile.disable()
+        cprofile.dump_stats(args['cprofile'])
+        pywikibot.output('\03{lightyellow}cProfile stats saved to\03{default}: %s' % args['cprofile'])
+    if args['profile']:
+        profiler.dump(args['profile'])
+        pywikibot.output('\03{lightyellow}Profile report saved to\03{default}: %s' % args['profile'])
 def get_ranking_cols(page):
     global args, config
     
     if args['revisionday'] != None:
-        history = page.getVersionHistory(forceReload = True, getAll = True)
-        
-        for rev in history:
+        for rev in iter_history(page):
             edit_time = datetime.datetime.strptime(rev[1], u'%Y-%m-%dT%H:%M:%SZ')
             if edit_time.date() < args['revisionday']: break
             lasttime = edit_time
             lastrev = rev
-        text = page.getOldVersion(lastrev[0])
+        text = page_text(page, lastrev[0])
         pywikibot.output('Using revision \03{lightgreen}#%d\03{default} made by \03{lightyellow}%s\03{default} on \03{lightaqua}%s\03{default} for ranking position reference' % (lastrev[0], lastrev[2], lasttime))
     else:
-        text = page.getOldVersion(page.latestRevision())
-        
+        text = page_text(page)
+    return split_ranking_cols(text)
+def split_ranking_cols(text):
     cols = []
     tags = config['tags']['ranking_columns']
     for tag in tags:
@@ -184,33 +323,63 @@ def get_ranking_cols(page):
     
     return cols
 def check_edit_restriction(page, opt):
-    global site, current_time, args
-    history = page.getVersionHistory(forceReload = True, getAll = True)
+    global site, current_time, args, run_state
     pywikibot.output("\03{lightyellow}Checking edit restriction for\03{default}: \03{lightaqua}%s\03{default}" % (page.title()))
     
+    # Last save made from here is checked first - page history is only read when it doesn't rule the edit out
+    restricted = local_edit_restriction(page, opt)
+    if restricted:
+        pywikibot.output("\03{lightaqua}%s\03{default}: %s (local run state)" % (page.title(), restricted))
+        return False
+    
     comment = __({'list':'list_update_summary','ranking':'ranking_update_summary'}[opt])
-    index = 0
-    while True:
-        try:
-            rev = history[index]
-            summary = rev[3]
-            if summary != comment: raise SkippedRevision(rev)
-                
-            edit_time = datetime.datetime.strptime(rev[1], u'%Y-%m-%dT%H:%M:%SZ')
+    for rev in iter_history(page):
+        summary = rev[3]
+        if summary != comment: continue
             
-            if args['extended']:
-                pywikibot.output("Last edit by a robot made on %s" % (edit_time.isoformat(' ')))
-            
-            try:
-                return compare_dates(edit_time, opt)
-            except EditRestrict, e:
-                pywikibot.output("\03{lightaqua}%s\03{default}: %s" % (page.title(), e.val))
-                return False
-        except SkippedRevision, e:
-            index += 1
-        except IndexError:
-            return True
+        edit_time = datetime.datetime.strptime(rev[1], u'%Y-%m-%dT%H:%M:%SZ')
+        
+        if args['extended']:
+            pywikibot.output("Last edit by a robot made on %s" % (edit_time.isoformat(' ')))
+        
+        try:
+            return compare_dates(edit_time, opt)
+        except EditRestrict, e:
+            pywikibot.output("\03{lightaqua}%s\03{default}: %s" % (page.title(), e.val))
+            return False
     return True
+def local_edit_restriction(page, opt):
+    # Reason the last save in the run state rules the edit out - None if it doesn't or there's no save
+    global run_state
+    last_save = run_state.last_save(page_key(page))
+    if last_save == None: return None
+    try: compare_dates(last_save, opt)
+    except EditRestrict, e: return e.val
+    return None
+def latest_revid(page):
+    # Read from page history every time - None if the page doesn't exist
+    for rev in iter_history(page, step = 1): return rev[0]
+    return None
+def iter_history(page, step = 10, max_step = 500):
+    # Yields (revid, timestamp, user, comment) newest first, fetching the history in growing batches
+    global site
+    params = {
+        'action': 'query',
+        'prop': 'revisions',
+        'titles': page.title(),
+        'rvprop': 'ids|timestamp|user|comment',
+        'rvlimit': step,
+    }
+    while True:
+        data = query.GetData(params, site)
+        for pageid in data['query']['pages']:
+            for rev in data['query']['pages'][pageid].get('revisions', []):
+                yield (rev['revid'], rev['timestamp'], rev.get('user', ''), rev.get('comment', ''))
+        
+        if 'query-continue' in data: params.update(data['query-continue']['revisions'])
+        elif 'continue' in data: params.update(data['continue'])
+        else: return
+        params['rvlimit'] = min(params['rvlimit'] * 2, max_step)
 def compare_dates(edit_time, opt):
     global current_time, config, args
     settings = config['edit_restriction'][opt]
@@ -232,14 +401,14 @@ def compare_dates(edit_time, opt):
 def process_list_talk(page):
     global site, config, args, msg, new_wikis, on_the_list, all_cats
     pywikibot.output('\n\03{lightyellow}Processing page:\03{default} \03{lightaqua}%s\03{default}' % page.title())
-    old_text = page.getOldVersion(page.latestRevision())
+    old_text = page_text(page)
     
     new_wikis = []
     lines = get_between(old_text, config['tags']['talk'])
     lines = lines.replace('\r','').strip().split('\n')
     
     new_lines = []
-    all = []
+    all = set()
     for i, line in enumerate(lines):
         lines[i] = pywikibot.replaceExcept(lines[i], ur"^\s+|\s+$", "",[])
         lines[i] = pywikibot.replaceExcept(lines[i], ur"\*\s*\[\[w:c:(.*?)\|(.*?)\]\]\s*-?\s*(.*)\s*", ur"{} \1 | \2 | \3",[])
@@ -284,7 +453,7 @@ def process_list_talk(page):
                 if cat not in all_cats: continue
                 categories.append(cat)
         lines[i] = '* <s>[[w:c:%s|%s]]</s>' % (info['wikia_code'], info['sitename'])
-        all.append(info['wikia_code'])
+        all.add(info['wikia_code'])
         new_lines.append(lines[i])
         new_wikis.append((info['wikia_code'],info['sitename'],categories))
     del lines
@@ -297,91 +466,128 @@ def process_list_talk(page):
     old_text = old_text.strip()
     new_text = new_text.strip()
     
-    queue_put(page, new_text, old_text = old_text, comment = __('talk_update_summary'))
+    # Struck wikis are only added by the list update - the talk page waits for it (see release_held_saves)
+    queue_put(page, new_text, old_text = old_text, comment = __('talk_update_summary'), hold = True)
 
-def strike_lazies(text, span_list):
-    span_list = reversed(span_list)
-    for start, end in span_list:
-        text = '%s<span>%s</span>%s' % (text[:start], text[start:end], text[end:])
-    return text
+def strike_lazies(text):
+    # Wraps every wiki link that isn't struck yet in <span> in one pass
+    # Returns new text and codes of the struck wikis (without duplicates, in order of appearance)
+    out = []
+    codes = []
+    seen = set()
+    last = 0
+    for match in lazy_links.finditer(text):
+        start, end = match.span()
+        # Only spaces and tabs are skipped - links right after a line ending with a tag are struck
+        before = start - 1
+        while before >= 0 and text[before] in ' \t': before -= 1
+        if before < 0 or text[before] == '>': continue
+        if match.group('url') and text[before] in '[]': continue
+        after = end
+        while after < len(text) and text[after] in ' \t': after += 1
+        if text[after:after+1] == '<': continue
         
+        out.append(text[last:start])
+        out.append('<span>%s</span>' % match.group(0))
+        last = end
+        code = (match.group('lcode') or match.group('ecode') or match.group('ucode')).strip()
+        if code not in seen:
+            seen.add(code)
+            codes.append(code)
+    out.append(text[last:])
+    return (''.join(out), codes)
+lazy_links = re.compile(r'(?P<link>\[\[w:c:(?P<lcode>[^\]\|]*)(\|[^\]]*)?\]\])'
+    r'|(?P<ext>\[https?://(www\.)?(?P<ecode>[\w\.-]+?)\.wikia\.com[^\s\]]*(\s[^\]\[]*)?\])'
+    r'|(?P<url>https?://(www\.)?(?P<ucode>[\w\.-]+?)\.wikia\.com[^\s\[\]<]*)', re.I | re.U)
+
 def find_lazies(page, text, new_lines, all):
-    global site, config, args, msg, new_wikis, on_the_list
+    global site, config, args, msg, new_wikis, on_the_list, profiler
     from httplib import InvalidURL as httplib_InvalidURL
     
     if args['extended']: pywikibot.output('\03{lightyellow}Scanning rest of the talk page for links\03{default}')
 
-    strikes = get_all_strikes('\n'.join(new_lines))
-    lazies = []
-    
-    patterns = [
-        '[^\>^\[^\]]\s*(?P<match>http:\/\/(www\.)?(?P<code>.*?)\.wikia\.com[\S^\[^\]]*)\s*[^\<^\[^\]]',
-        '[^\>]\s*(?P<match>\[http:\/\/(www\.)?(?P<code>.*?)\.wikia\.com[\S^\[^\]]*\s*[^\[^\]]*\])\s*[^\<]',
-        '[^\>]\s*(?P<match>\[\[w:c:(?P<code>.*?)(\|.*?)?\]\])\s*[^\<]',
-    ]
-    pattern = re.compile('[^\>^\]]\s*http:\/\/(www\.)?(.*?)\.wikia\.com\s*[^\<]', re.I)
-    old_text = text
-    for pattern in patterns:
-        rx = re.compile(pattern, re.I)
-        iter = rx.finditer(text)
-        strike = []
-        while True:
-            try: match = iter.next()
-            except StopIteration: break
-            else:
-                lazies.append(match.group('code').strip())
-                strike.append(match.span('match'))
-        text = strike_lazies(text, strike)
+    strikes = set(get_all_strikes('\n'.join(new_lines)))
+    listed = set(on_the_list)
+    start = time.time()
+    text, lazies = strike_lazies(text)
+    profiler.add('strike_lazies', time.time() - start)
     
     for rec in lazies:
         if rec in strikes: continue
         if rec in all: continue
-        if rec in on_the_list: continue
+        if rec in listed: continue
         try: info = get_wiki_info(rec)
         except JSONError: continue
         except InvalidWiki: continue
         except httplib_InvalidURL: continue
         else:
             if info['wikia_code'] in all: continue
-            if info['wikia_code'] in on_the_list: continue
+            if info['wikia_code'] in listed: continue
             if info['lang'] not in config['languages']: continue
             new_lines.append('* <s>[[w:c:%(wikia_code)s|%(sitename)s]]</s>' % info)
-            all.append(rec)
+            all.add(rec)
+            all.add(info['wikia_code'])
             new_wikis.append((info['wikia_code'],info['sitename'],[]))
     return (new_lines, all, text)
 
 def start_rankings():
-    global site, config, args, wikis, all_cats
+    global site, config, args, wikis, all_cats, profiler
+    
+    with profiler.phase('build_rankings'): rankings = build_rankings(wikis, all_cats)
     
     main_article = pywikibot.Page(site, config['pages']['ranking_main_article'])
     main_image = pywikibot.Page(site, config['pages']['ranking_main_image'])
     
-    process_ranking(main_article)
-    process_ranking(main_image, image=True)
+    with profiler.phase('process_ranking: %s' % main_article.title()): process_ranking(main_article, rankings[(None, 'articles')])
+    with profiler.phase('process_ranking: %s' % main_image.title()): process_ranking(main_image, rankings[(None, 'images')], image=True)
     
     for cat in all_cats:
         pywikibot.output('')
         cat_article = pywikibot.Page(site, config['pages']['ranking_category_article'] % cat)
         cat_image = pywikibot.Page(site, config['pages']['ranking_category_image'] % cat)
-        process_ranking(cat_article, cat=cat)
-        process_ranking(cat_image, cat=cat, image=True)
+        with profiler.phase('process_ranking: %s' % cat_article.title()): process_ranking(cat_article, rankings[(cat.lower(), 'articles')], cat=cat)
+        with profiler.phase('process_ranking: %s' % cat_image.title()): process_ranking(cat_image, rankings[(cat.lower(), 'images')], cat=cat, image=True)
     
     return
-def process_ranking(page, cat=None, image=False):
+def build_rankings(wikis, cats):
+    # Returns {(category, 'articles'|'images'): ranklist} - category is None for main rankings
+    # Every ranklist is ordered by count, highest first
+    global config
+    rankings = {}
+    for key in ['articles', 'images']:
+        rankings[(None, key)] = []
+        for cat in cats: rankings[(cat.lower(), key)] = []
+    
+    for key, limit in [('articles', 'article'), ('images', 'image')]:
+        main_limit = config['limits']['main_'+limit]
+        cat_limit = config['limits']['category_'+limit]
+        ordered = sorted([wiki for wiki in wikis if wiki['users'] != 0], key = lambda wiki: -wiki[key])
+        for wiki in ordered:
+            count = wiki[key]
+            if count < main_limit and count < cat_limit: break
+            
+            rec = RankRecord(code = wiki['code'], name = wiki['display'] or wiki['name'], count = count)
+            if count >= main_limit: rankings[(None, key)].append(rec)
+            if count < cat_limit: continue
+            for cat in set(wiki['categories']):
+                if (cat, key) in rankings: rankings[(cat, key)].append(rec)
+    return rankings
+def process_ranking(page, ranklist, cat=None, image=False):
     global site, config, args, wikis
     pywikibot.output('\n\03{lightyellow}Processing \03{lightgreen}%s\03{lightyellow} ranking by\03{lightpurple} %s\03{default}:  \03{lightaqua}%s\03{default}' % ( ('%s\03{lightyellow} category'%cat,'main')[cat==None], ('article','image')[image], page.title()))
     
-    if not page.exists():
-        pywikibot.output('\03{lightyellow}Page not found\03{default}: skipping this ranking')
-        return
-    
     if args['forceranking']: edit_restrict = True
     else: edit_restrict = check_edit_restriction(page, 'ranking');
     if not edit_restrict:
         pywikibot.output('\03{lightyellow}Edit restricted\03{default}: skipping this ranking')
         return
     
-    cols = get_ranking_cols(page)
+    if not page_exists(page):
+        pywikibot.output('\03{lightyellow}Page not found\03{default}: skipping this ranking')
+        return
+    
+    old_text = page_text(page)
+    cols = split_ranking_cols(old_text)
     
     col_count = len(cols)
     if col_count == 0:
@@ -389,59 +595,53 @@ def process_ranking(page, cat=None, image=False):
         return
         
     if args['clean']: old_ranking = None
-    else: old_ranking = get_old_ranking('\n'.join(cols))
+    else: old_ranking = get_reference_ranking(page, cols)
     
-    ranklist=[]
+    places = {}
+    rendered = render_ranking(ranklist, old_ranking = old_ranking, places = places)
+    rendered = chunkIt(rendered, col_count)
     
-    if image: key = 'image'
-    else: key = 'article'
-        
-    if cat==None:
-        limit = config['limits']['main_'+key]
-    else:
-        limit = config['limits']['category_'+key]
-        cat = cat.lower()
+    splice = lambda text: splice_ranking(text, rendered, len(ranklist))
+    new_text = splice(old_text)
     
-    key = key+'s'
+    summary = None
+    if old_ranking != None:
+        moved = len([code for code in places if code in old_ranking and old_ranking[code] != places[code]])
+        added = len([code for code in places if code not in old_ranking])
+        dropped = len([code for code in old_ranking if code not in places])
+        summary = 'wikis: %d, moved: %d, new: %d, dropped: %d' % (len(places), moved, added, dropped)
     
-    for wiki in wikis:
-        if wiki['users'] == 0 or wiki[key] < limit: continue
-        if cat!=None and cat not in wiki['categories']: continue
-        
-        if wiki['display']: name = wiki['display']
-        else: name = wiki['name']
-        
-        ranklist.append({
-            'code': wiki['code'],
-            'name': name,
-            'count': wiki[key]
-        })
-    
-    rendered = render_ranking(ranklist, old_ranking = old_ranking)
-    rendered = chunkIt(rendered, col_count)
+    queue_put(page, new_text, old_text = old_text, comment = __('ranking_update_summary'), on_saved = lambda: ranking_archive.store(page.title(), places, current_time.date()), rebuild = splice, summary = summary)
     
+def splice_ranking(text, rendered, count):
+    global config
     tags = config['tags']['ranking_columns']
-    
-    old_text = page.getOldVersion(page.latestRevision())
-    new_text = old_text
     for i, rend in enumerate(rendered):
         rend = '\n'.join(rend)
-        new_text = put_between(new_text, tags[i], '\n%s\n' % rend)
-    
-    new_text = pywikibot.replaceExcept(new_text, ur'<span (.*?)id="data"(.*?)>.*?</span>', r'<span \1id="data"\2>{{subst:#time:j xg Y}}</span>',[])
-    new_text = pywikibot.replaceExcept(new_text, ur'<span (.*?)id="licznik"(.*?)>.*?</span>', (r'<span \1id="licznik"\2>%i</span>'%(len(ranklist))),[])
-    
-    queue_put(page, new_text, old_text = old_text, comment = __('ranking_update_summary'))
+        text = put_between(text, tags[i], '\n%s\n' % rend)
     
-def render_ranking(wikis, old_ranking = None):
+    text = pywikibot.replaceExcept(text, ur'<span (.*?)id="data"(.*?)>.*?</span>', r'<span \1id="data"\2>{{subst:#time:j xg Y}}</span>',[])
+    text = pywikibot.replaceExcept(text, ur'<span (.*?)id="licznik"(.*?)>.*?</span>', (r'<span \1id="licznik"\2>%i</span>'%count),[])
+    return text
+def get_reference_ranking(page, cols):
+    global args, ranking_archive
+    ranking = ranking_archive.find(page.title(), args['revisionday'])
+    if ranking != None:
+        if args['extended']: pywikibot.output('Using archived ranking snapshot for ranking position reference')
+        return ranking
+    
+    if args['revisionday'] != None: cols = get_ranking_cols(page)
+    return get_old_ranking('\n'.join(cols))
+def render_ranking(wikis, old_ranking = None, places = None):
+    # wikis have to be ordered by count, highest first (see build_rankings)
     global args
-    qs(wikis, 'count')
     rend = []
     template = prepare_template('ranking_record')
     
     last_count = 0
-    place = 1
-    for wiki in reversed(wikis):
+    last_place = place = 1
+    for rec in wikis:
+        wiki = dict(rec)
         code = wiki['code']
         if place == 1: wiki['place'] = place
         else:
@@ -455,6 +655,11 @@ def render_ranking(wikis, old_ranking = None):
             elif old_ranking[code] < place: wiki['move'] = '--'
             else:                           wiki['move'] = '//'
                 
+        if places != None:
+            # Same positions get_old_ranking would read back from the rendered page
+            if wiki['place'] != '': last_place = wiki['place']
+            places[code] = last_place
+        
         wiki['place'] = '%-3s' % wiki['place']
         wiki['count'] = '%7s' % wiki['count']
         rend.append(template % wiki)
@@ -463,22 +668,15 @@ def render_ranking(wikis, old_ranking = None):
     return rend
 def get_old_ranking(text):
     ranking = {}
-    basic = re.compile("\{\{\s*%s(.*?)\}\}"%re.escape(config['templates']['ranking_record'][0]), re.S)
     last_place = 1
-    iter = basic.finditer(text)
-    while True:
-        try: match = iter.next().group(0)
-        except StopIteration: break
-        except AttributeError: continue
-        else:
-            info = template_params(match, 'ranking_record')
-            info['place'] = info['place'].replace('.','')
-            
-            info['code'] = pywikibot.replaceExcept(info['code'], r'\[\[w:c:', r'', [])
-            if not info['place']: info['place'] = last_place
-            
-            last_place = info['place'] = int(info['place'])
-            ranking[info['code']] = info['place']
+    for info in parse_templates(text, 'ranking_record'):
+        info['place'] = info['place'].replace('.','')
+        
+        info['code'] = pywikibot.replaceExcept(info['code'], r'\[\[w:c:', r'', [])
+        if not info['place']: info['place'] = last_place
+        
+        last_place = info['place'] = int(info['place'])
+        ranking[info['code']] = info['place']
     return ranking
 def chunkIt(seq, num):
     l = len(seq)
@@ -493,78 +691,66 @@ def chunkIt(seq, num):
         new.append(seq[x[0]:x[1]])
     return new
 def preprocess_list(page):
-    global site, config, args, msg, on_the_list, old_list_text, wikis
+    global site, config, args, msg, on_the_list, old_list_text, old_list_revid, wikis
     pywikibot.output('\n\03{lightyellow}Processing page:\03{default} \03{lightaqua}%s\03{default}' % page.title())
-    index = 0
     
-    history = page.getVersionHistory(forceReload = True, getAll = True)
+    history = iter_history(page, step = 50)
     while True:
-        try:
-            rev = history[index]
-            if not allowed_edit(rev[2]): raise SkippedRevision(rev)
-            pywikibot.output("Processing revision \03{lightgreen}#%d\03{default} made by \03{lightyellow}%s\03{default}" % (rev[0], rev[2]))
-            old_list_text = page.getOldVersion(rev[0])
-            return process_list_revision(old_list_text)
-        except SkippedRevision, e:
-            if e.err: pywikibot.output("\03{lightpurple}Skipping\03{default} revision \03{lightgreen}#%d\03{default} made by \03{lightyellow}%s\03{default} - revision produced an error: %s" % (e.rev[0], e.rev[2], e.err))
-            else: pywikibot.output("\03{lightpurple}Skipping\03{default} revision \03{lightgreen}#%d\03{default} made by \03{lightyellow}%s\03{default} - user not allowed to edit that page" % (rev[0], rev[2]))
-            index += 1
-        except IndexError:
-            pywikibot.output('\n\n\03{lightred}FATAL ERROR:\03{default} Script has run out of revisions for \03{lightaqua}%s\03{default}' % page.title())
-            return exit('OutOfRevisions')
-            break
+        batch = list(itertools.islice(history, 50))
+        if not batch: break
+        # Rights of all editors in the batch are checked in one request
+        resolve_user_rights([rev[2] for rev in batch])
+        for rev in batch:
+            try:
+                if not allowed_edit(rev[2]): raise SkippedRevision(rev)
+                pywikibot.output("Processing revision \03{lightgreen}#%d\03{default} made by \03{lightyellow}%s\03{default}" % (rev[0], rev[2]))
+                old_list_text = page_text(page, rev[0])
+                old_list_revid = rev[0]
+                return process_list_revision(old_list_text)
+            except SkippedRevision, e:
+                if e.err: pywikibot.output("\03{lightpurple}Skipping\03{default} revision \03{lightgreen}#%d\03{default} made by \03{lightyellow}%s\03{default} - revision produced an error: %s" % (e.rev[0], e.rev[2], e.err))
+                else: pywikibot.output("\03{lightpurple}Skipping\03{default} revision \03{lightgreen}#%d\03{default} made by \03{lightyellow}%s\03{default} - user not allowed to edit that page" % (rev[0], rev[2]))
+    
+    pywikibot.output('\n\n\03{lightred}FATAL ERROR:\03{default} Script has run out of revisions for \03{lightaqua}%s\03{default}' % page.title())
+    return exit('OutOfRevisions')
     
 def process_list_revision(text):
     global site, config, args, msg, on_the_list, old_list_text, wikis, all_cats
         
     list = get_between(text, config['tags']['categories'])
-    basic = re.compile("\{\{\s*%s(.*?)\}\}"%re.escape(config['templates']['category_record'][0]), re.S)
     all_cats = []
-    iter = basic.finditer(list)
-    while True:
-        try: match = iter.next().group(0)
-        except StopIteration: break
+    for info in parse_templates(list, 'category_record'):
+        try:
+            all_cats.append(info['name'].lower().strip())
         except AttributeError: continue
-        else:
-            try:
-                info = template_params(match, 'category_record')
-                all_cats.append(info['name'].lower().strip())
-            except AttributeError: continue
-            except KeyError: continue
+        except KeyError: continue
     
     list = get_between(text, config['tags']['list'])
-    basic = re.compile("\{\{\s*%s(.*?)\}\}"%re.escape(config['templates']['list_record'][0]), re.S)
     count = 0
     on_the_list = []
     wikis = []
-    iter = basic.finditer(list)
-    while True:
-        try: match = iter.next().group(0)
-        except StopIteration: break
-        except AttributeError: continue
-        else:
-            try:
-                count += 1
-                info = template_params(match, 'list_record')
-                if 'code' not in info:
-                    match = re.compile('http:\/\/(www\.)?(.*?)\.wikia\.com', re.I).search(info['address'])
-                    info['code'] = match.group(2).strip()
-                    
-                cats = []
-                if 'categories' in info:
-                    info['categories'] = info['categories'].split(',')
-                    for cat in info['categories']:
-                        cat = cat.lower().strip()
-                        if not cat: continue
-                        if cat not in all_cats: continue
-                        cats.append(cat)
-                sorted(cats)
-                info['categories'] = cats
+    for info in parse_templates(list, 'list_record'):
+        try:
+            count += 1
+            if 'code' not in info:
+                match = re.compile('http:\/\/(www\.)?(.*?)\.wikia\.com', re.I).search(info['address'])
+                info['code'] = match.group(2).strip()
                 
-                wikis.append(info)
-                on_the_list.append(info['code'])
-            except AttributeError: continue
-            except KeyError: continue
+            cats = []
+            if 'categories' in info:
+                info['categories'] = info['categories'].split(',')
+                for cat in info['categories']:
+                    cat = cat.lower().strip()
+                    if not cat: continue
+                    if cat not in all_cats: continue
+                    cats.append(cat)
+            sorted(cats)
+            info['categories'] = cats
+            
+            wikis.append(info)
+            on_the_list.append(info['code'])
+        except AttributeError: continue
+        except KeyError: continue
     if count and len(wikis) == 0: raise SkippedRevision(rev, 'found %s entries but none yielded any resutlts' % count)
 def process_list(page):
     global site, config, args, old_list_text, wikis, msg, new_wikis, all_cats
@@ -602,39 +788,142 @@ def process_list(page):
         wiki['users'] = 0
         wiki['admins'] = 0
     
+    if args['offline']: the_list = load_snapshot(args['offline'])
+    else:
+        the_list = collect_list(lens)
+        if args['snapshot']: save_snapshot(args['snapshot'], page, the_list)
+    with profiler.phase('preload_pages'): preload_updated_pages()
+    listed = set([rec['code'] for rec in the_list])
+    
+    qs(the_list, 'visible')
+    old_codes = set([wiki['code'] for wiki in wikis])
+    summary = 'wikis: %d, new: %d, removed: %d' % (len(the_list), len(listed - old_codes), len(old_codes - listed))
+    wikis = the_list
+    
+    aggregate_categories(the_list, cats)
+    console_end()
+    
+    for cat in cats: lens['catname'] = max(lens['catname'], len(cats[cat]['name']))
+    console_table(['Name','Avg. articles','Median','Wikis','Avg. images','Median','Wikis'], widths = [lens['catname']])
+    for cat in cats:
+        row = [cats[cat]['name'],cats[cat]['articles'],cats[cat]['artmedian'],cats[cat]['artcount'],cats[cat]['images'],cats[cat]['imgmedian'],cats[cat]['imgcount']]
+        console_row(row)
+    console_end()
+    args['extended'] = args['extended_bak']
+    
+    render = []
+    template = prepare_template('list_record')
+    list_count = 0
+    inactive_count = 0
+    for rec in the_list:
+        rec['categories'] = sorted(rec['categories'])
+        render.append(template % dict(rec, categories = ', '.join(rec['categories'])))
+        list_count += 1
+        if rec['users'] == 0:
+            inactive_count += 1
+    list_render = "\n%s\n" % "\n".join(render)
+    
+    cats = cats.values()
+    qs(cats, 'name')
+    
+    render = []
+    template = prepare_template('category_record')
+    cats_count = 0
+    for cat in cats:
+        render.append(template % cat)
+        cats_count += 1
+    cats_render = "\n%s\n" % "\n".join(render)
+    
+    splice = lambda text: put_between(put_between(text, config['tags']['list'], list_render), config['tags']['categories'], cats_render)
+    new_list_text = splice(old_list_text)
+    
+    release_held_saves(queue_put(page, new_list_text, old_text = old_list_text, comment = __('list_update_summary'), rebuild = splice, summary = summary))
+    save_column(config['pages']['list_column'], list_count, inactive_count)
+    save_column(config['pages']['list_cat_column'], cats_count)
+
+def aggregate_categories(the_list, cats):
+    # Counts of wikis above category limits are gathered per category in one pass, then summed up per category
+    # For articles (art*) and images (img*): average (articles/images), count, total, median, p25, p75 and p90
+    global config
+    values = {}
+    for key in cats: values[key] = ([], [])
+    art_limit = config['limits']['category_article']
+    img_limit = config['limits']['category_image']
+    for rec in the_list:
+        articles = rec['articles']
+        images = rec['images']
+        if articles < art_limit and images < img_limit: continue
+        for cat in set([x.lower() for x in rec['categories']]):
+            lists = values.get(cat.lower())
+            if lists == None: continue
+            if articles >= art_limit: lists[0].append(articles)
+            if images >= img_limit: lists[1].append(images)
+    
+    for key in cats:
+        for prefix, avg, counts in [('art', 'articles', values[key][0]), ('img', 'images', values[key][1])]:
+            counts.sort()
+            total = sum(counts)
+            if counts: cats[key][avg] = round(float(total) / len(counts), 2)
+            else: cats[key][avg] = 0.0
+            cats[key][prefix + 'count'] = len(counts)
+            cats[key][prefix + 'total'] = total
+            cats[key][prefix + 'median'] = round(percentile(counts, 50), 2)
+            for p in [25, 75, 90]: cats[key]['%sp%d' % (prefix, p)] = round(percentile(counts, p), 2)
+    return cats
+def percentile(values, p):
+    # values have to be sorted - linear interpolation between closest ranks, 0 for no values
+    if not values: return 0
+    rank = (len(values) - 1) * p / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+def preload_updated_pages():
+    # Column and ranking pages - read after stats are fetched, so edits made during that aren't lost
+    # Rankings ruled out by the run state are left out - process_ranking skips them without reading anything
+    global site, config, args, all_cats, page_store
+    rankings = [config['pages'][x] for x in ['ranking_main_article', 'ranking_main_image']]
+    rankings += [config['pages'][x] % cat for cat in all_cats for x in ['ranking_category_article', 'ranking_category_image']]
+    pages = [pywikibot.Page(site, config['pages'][x]) for x in ['list_column', 'list_cat_column']]
+    for page in [pywikibot.Page(site, title) for title in rankings]:
+        if args['forceranking'] or not local_edit_restriction(page, 'ranking'): pages.append(page)
+    page_store.preload(pages)
+def collect_list(lens):
+    # Fetches stats of wikis on the list and new ones from its talk page - returns list of WikiRecords
+    global args, wikis, new_wikis
+    codes = [wiki['code'] for wiki in wikis] + [wiki[0] for wiki in new_wikis]
+    prefetch_stats(codes)
+    jobs = pool.map(fetch_wiki_data, codes)
+    new_jobs = jobs[len(wikis):]
+    jobs = jobs[:len(wikis)]
+    
     the_list = []
+    listed = set()
     args['extended'] = False
     console_table(['Name','*','Code','Categories','Articles','Images','Users','Admins'], widths = [lens['name'],1,lens['code'],lens['cats'],lens['art'],lens['img'],lens['usr'],lens['adm']])
     
-    for wiki in wikis:
+    for wiki, (code, job) in zip(wikis, jobs):
         comment = ''
         try:
-            data = get_wiki_statinfo(wiki['code'])
-            admins = get_wiki_admins(wiki['code'], active=True)
+            data, admins = job.result()
         except InvalidWiki, e:
             comment = '\03{lightred}DELETE\03{default} - %s' % ('wiki not found','wiki closed')[e.closed]
             console_row([wiki['display'] or wiki['name'],' ',wiki['code'],'','','','',''], comment=comment)
             continue
         
-        rec = {
-            'code': data['info']['wikia_code'],
-            'name': data['info']['sitename'],
-            'display': wiki.setdefault('display',''),
-            'visible': '',
-            'address': data['info']['server'],
-            'categories': wiki.setdefault('categories',[]),
-            'articles': data['stats']['articles'],
-            'images': data['stats']['images'],
-            'users': data['stats']['activeusers'],
-            'admins': len(admins),
-        }
+        rec = WikiRecord(
+            code = data['info']['wikia_code'],
+            name = data['info']['sitename'],
+            display = wiki.setdefault('display',''),
+            visible = '',
+            address = data['info']['server'],
+            categories = wiki.setdefault('categories',[]),
+            articles = data['stats']['articles'],
+            images = data['stats']['images'],
+            users = data['stats']['activeusers'],
+            admins = len(admins),
+        )
         
-        skip = False
-        for w in the_list:
-            if w['code'] == rec['code']:
-                skip = True
-                break
-        if skip: continue
+        if rec['code'] in listed: continue
         
         if type(rec['categories']) != list:
             rec['categories'] = [rec['categories']]
@@ -650,40 +939,35 @@ def process_list(page):
         
         if rec['articles'] != 0:
             the_list.append(rec)
+            listed.add(rec['code'])
         else:
             comment = '\03{lightred}DELETE\03{default} - no articles'
         
         console_row([rec['visible'],(' ','*')[flag],rec['code'],', '.join(rec['categories']),rec['articles'],rec['images'],rec['users'],rec['admins']], color=(None,'lightred')[rec['users']==0],comment=comment)
     console_end(True)
     
-    for wiki in new_wikis:
+    for wiki, (code, job) in zip(new_wikis, new_jobs):
         code, name, catz = wiki
         
         try:
-            data = get_wiki_statinfo(code)
-            admins = get_wiki_admins(code, active=True)
+            data, admins = job.result()
         except InvalidWiki, e:
             continue
         
-        rec = {
-            'code': data['info']['wikia_code'],
-            'name': data['info']['sitename'],
-            'display': '',
-            'visible': data['info']['sitename'],
-            'address': data['info']['server'],
-            'categories': catz,
-            'articles': data['stats']['articles'],
-            'images': data['stats']['images'],
-            'users': data['stats']['activeusers'],
-            'admins': len(admins),
-        }
+        rec = WikiRecord(
+            code = data['info']['wikia_code'],
+            name = data['info']['sitename'],
+            display = '',
+            visible = data['info']['sitename'],
+            address = data['info']['server'],
+            categories = catz,
+            articles = data['stats']['articles'],
+            images = data['stats']['images'],
+            users = data['stats']['activeusers'],
+            admins = len(admins),
+        )
         
-        skip = False
-        for w in the_list:
-            if w['code'] == rec['code']:
-                skip = True
-                break
-        if skip: continue
+        if rec['code'] in listed: continue
         
         if type(rec['categories']) != list:
             rec['categories'] = [rec['categories']]
@@ -693,70 +977,132 @@ def process_list(page):
         
         console_row([rec['visible'],' ',rec['code'],', '.join(rec['categories']),rec['articles'],rec['images'],rec['users'],rec['admins']], color=(None,'lightred')[rec['users']==0])
         the_list.append(rec)
-    
-    qs(the_list, 'visible')
-    wikis = the_list
-    
-    for rec in the_list:
-        for cat in rec['categories']:
-            try:
-                key = cat.lower()
-                if rec['articles'] >= config['limits']['category_article']:
-                    cats[key]['articles'] += rec['articles']
-                    cats[key]['artcount'] += 1
-                if rec['images'] >= config['limits']['category_image']:
-                    cats[key]['images'] += rec['images']
-                    cats[key]['imgcount'] += 1
-            except KeyError: continue
-    console_end()
-    
-    for cat in cats: lens['catname'] = max(lens['catname'], len(cats[cat]['name']))
-    console_table(['Name','Avg. articles','Wikis','Avg. images','Wikis'], widths = [lens['catname']])
-    for cat in cats:
-        if cats[cat]['artcount']: cats[cat]['articles'] = float(float(cats[cat]['articles'])/cats[cat]['artcount'])
-        else: cats[cat]['articles'] = 0
-        if cats[cat]['imgcount']: cats[cat]['images'] = float(float(cats[cat]['images'])/cats[cat]['imgcount'])
-        else: cats[cat]['images'] = 0
-        cats[cat]['articles'] = round(cats[cat]['articles'],2)
-        cats[cat]['images'] = round(cats[cat]['images'],2)
-        
-        row = [cats[cat]['name'],cats[cat]['articles'],cats[cat]['artcount'],cats[cat]['images'],cats[cat]['imgcount']]
-        console_row(row)
-    console_end()
-    args['extended'] = args['extended_bak']
-    
-    render = []
-    template = prepare_template('list_record')
-    list_count = 0
-    inactive_count = 0
-    for rec in the_list:
-        rec['categories'] = sorted(rec['categories'])
-        rec['categories'] = ', '.join(rec['categories'])
-        render.append(template % rec)
-        list_count += 1
-        if rec['users'] == 0:
-            inactive_count += 1
-    new_list_text = put_between(old_list_text, config['tags']['list'], "\n%s\n" % "\n".join(render))
-    
-    cats = cats.values()
-    qs(cats, 'name')
-    
-    render = []
-    template = prepare_template('category_record')
-    cats_count = 0
-    for cat in cats:
-        render.append(template % cat)
-        cats_count += 1
-    new_list_text = put_between(new_list_text, config['tags']['categories'], "\n%s\n" % "\n".join(render))
-    
-    queue_put(page, new_list_text, old_text = old_list_text, comment = __('list_update_summary'))
-    save_column(config['pages']['list_column'], list_count, inactive_count)
-    save_column(config['pages']['list_cat_column'], cats_count)
-
+        listed.add(rec['code'])
+    return the_list
+def save_snapshot(path, page, the_list):
+    # Everything needed to render the list and rankings again without fetching stats (see -offline)
+    global current_time
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory): os.makedirs(directory)
+    f = gzip.open(path + '.tmp', 'wb')
+    try: json.dump({'created': current_time.isoformat(' '), 'list': page.title(), 'wikis': [dict(rec) for rec in the_list]}, f, separators = (',', ':'))
+    finally: f.close()
+    if os.path.exists(path): os.remove(path)
+    os.rename(path + '.tmp', path)
+    pywikibot.output('\03{lightyellow}Stats snapshot saved to\03{default}: %s' % path)
+def load_snapshot(path):
+    f = gzip.open(path, 'rb')
+    try: snapshot = json.load(f)
+    finally: f.close()
+    pywikibot.output('\03{lightyellow}Using stats snapshot\03{default} of \03{lightaqua}%s\03{default} created on %s: %d wikis' % (snapshot['list'], snapshot['created'], len(snapshot['wikis'])))
+    return [WikiRecord(**dict([(str(key), value) for key, value in wiki.items()])) for wiki in snapshot['wikis']]
+def fetch_wiki_data(code):
+    global args, shard_results
+    if shard_results != None and code in shard_results:
+        rec = shard_results[code]
+        if 'closed' in rec: raise InvalidWiki(rec['url'], rec['closed'])
+        return tuple(rec['data'])
+    if args['incremental']: return fetch_wiki_data_incremental(code)
+    return (get_wiki_statinfo(code), get_wiki_admins(code, active=True))
+def prefetch_stats(codes):
+    # Lets the stats backend fetch counts of many wikis at once, before wikis are fetched one by one
+    global args, shard_results, json_cache, stats_backend
+    if shard_results != None: codes = [code for code in codes if code not in shard_results]
+    # Incremental mode fetches counts of changed wikis again even if they're in the cache
+    if not args['incremental']: codes = [code for code in codes if json_cache.get('stats', code) == None]
+    stats_backend.prefetch(codes)
+def fetch_wiki_data_incremental(code):
+    # Counts from the last fetch are reused as long as the newest recent change of the wiki is the same
+    # Every wiki is still fetched in full after being reused args['fullrefresh'] - 1 times in a row
+    global args, json_cache
+    changed = get_wiki_last_change(code)
+    last = json_cache.get('changes', code)
+    if last != None and last['changed'] == changed and last['reused'] + 1 < args['fullrefresh']:
+        json_cache.set('changes', code, dict(last, reused = last['reused'] + 1))
+        return tuple(last['data'])
+    
+    data = (get_wiki_statinfo(code, useCache = False), get_wiki_admins(code, active = True, useCache = False))
+    json_cache.set('changes', code, {'changed': changed, 'data': data, 'reused': 0})
+    return data
+def shard_of(code, count):
+    # Same wiki always lands in the same shard, no matter where it is on the list
+    if isinstance(code, unicode): code = code.encode('utf-8')
+    return (zlib.crc32(code) & 0xffffffff) % count + 1
+def shard_path(shard, count):
+    global args
+    return os.path.join(args['shards'], 'shard-%d-of-%d.json' % (shard, count))
+def collect_shard():
+    global args, wikis, current_time, old_list_revid
+    shard, count = args['shard']
+    codes = [wiki['code'] for wiki in wikis if shard_of(wiki['code'], count) == shard]
+    pywikibot.output('\n\03{lightyellow}Collecting shard \03{lightaqua}%d/%d\03{lightyellow}:\03{default} %d of %d wikis' % (shard, count, len(codes), len(wikis)))
+    
+    results = {}
+    prefetch_stats(codes)
+    for code, job in pool.map(fetch_wiki_data, codes):
+        try: results[code] = {'data': job.result()}
+        except InvalidWiki, e: results[code] = {'url': e.url, 'closed': e.closed}
+        except JSONError, e:
+            # Left out of the shard - -merge fetches it again
+            pywikibot.output('\03{lightred}%s\03{default}: %s' % (code, e))
+    
+    path = shard_path(shard, count)
+    if not os.path.isdir(args['shards']): os.makedirs(args['shards'])
+    f = open(path + '.tmp', 'w')
+    try: json.dump({'shard': shard, 'count': count, 'created': current_time.isoformat(' '), 'time': time.time(), 'revid': old_list_revid, 'wikis': results}, f, separators = (',', ':'))
+    finally: f.close()
+    if os.path.exists(path): os.remove(path)
+    os.rename(path + '.tmp', path)
+    pywikibot.output('\03{lightyellow}Shard saved to\03{default}: %s (%d wikis)' % (path, len(results)))
+def load_shards(directory):
+    # Returns {code: result} from shards of one split made from the current list revision, at most args['shardage'] hours ago
+    # Wikis missing from them are fetched as usual
+    global args, old_list_revid, shard_files
+    shards = []
+    names = os.path.isdir(directory) and os.listdir(directory) or []
+    for name in sorted(names):
+        match = re.match(r'^shard-(\d+)-of-(\d+)\.json$', name)
+        if not match: continue
+        path = os.path.join(directory, name)
+        f = open(path)
+        try: shard = json.load(f)
+        finally: f.close()
+        if shard.get('revid') != old_list_revid:
+            pywikibot.output('\03{lightred}Ignoring shard\03{default} %s - made from another list revision' % name)
+        elif time.time() - shard.get('time', 0) > args['shardage'] * 3600:
+            pywikibot.output('\03{lightred}Ignoring shard\03{default} %s - created on %s, more than %d hours ago' % (name, shard['created'], args['shardage']))
+        else: shards.append((path, shard))
+    
+    # Only the split of the newest shard is used
+    count = None
+    if shards: count = max(shards, key = lambda x: x[1]['time'])[1]['count']
+    results = {}
+    found = set()
+    shard_files = []
+    for path, shard in shards:
+        if shard['count'] != count:
+            pywikibot.output('\03{lightred}Ignoring shard\03{default} %s - list is split in %d parts by newer shards' % (os.path.basename(path), count))
+            continue
+        found.add(shard['shard'])
+        shard_files.append(path)
+        results.update(shard['wikis'])
+        pywikibot.output('\03{lightyellow}Loaded shard \03{lightaqua}%d/%d\03{default} created on %s: %d wikis' % (shard['shard'], shard['count'], shard['created'], len(shard['wikis'])))
+    if count != None:
+        missing = sorted(set(range(1, count + 1)) - found)
+        if missing: pywikibot.output('\03{lightred}Missing shards\03{default} %s of %d - their wikis will be fetched now' % (', '.join([str(x) for x in missing]), count))
+    else: pywikibot.output('\03{lightred}No shards found in\03{default} %s - all wikis will be fetched now' % directory)
+    return results
+def retire_shards():
+    # Merged shards are kept as *.merged, so they aren't used again
+    global shard_files
+    for path in shard_files:
+        if os.path.exists(path + '.merged'): os.remove(path + '.merged')
+        os.rename(path, path + '.merged')
+    if shard_files: pywikibot.output('\03{lightyellow}Merged shards renamed\03{default}: %d' % len(shard_files))
 def save_column(pagename, count, inactive=0):
     global site
     page = pywikibot.Page(site, pagename)
-    old = page.getOldVersion(page.latestRevision())
+    old = page_text(page)
     
     column = []
     column.append('{| class="{{{class|article-table}}}" style="{{{style|}}}"\n! style="{{{th_style|}}}" | {{{1}}}')
@@ -769,26 +1115,34 @@ def save_column(pagename, count, inactive=0):
     
     column = '%s' % '\n'.join(column)
     new = ''
+    splice = lambda text: put_between(text, ['<onlyinclude>','</onlyinclude>'], column)
     try:
-        new = put_between(old, ['<onlyinclude>','</onlyinclude>'], column)
+        new = splice(old)
     except TagsNotFound:
         pywikibot.output('\n\03{lightyellow}<onlyinclude>\03{default} tags not found. Replacing whole text')
         new = "<onlyinclude>%s</onlyinclude>" % column
-    queue_put(page, new, old_text = old, comment = __('column_update_summary') % {'count':count})
-def queue_put(page, new_text, old_text = None, comment = None):
-    global page_save_queue
+        splice = lambda text: new
+    queue_put(page, new, old_text = old, comment = __('column_update_summary') % {'count':count}, rebuild = splice)
+def queue_put(page, new_text, old_text = None, comment = None, on_saved = None, rebuild = None, summary = None, hold = False):
+    # rebuild(text) re-applies the update to the latest text of the page in case of an edit conflict
+    # summary is shown with the difference in simulation mode
+    # With hold the save waits for release_held_saves - returns the save job otherwise (None if nothing is saved)
+    global page_save_queue, page_held_saves
     try: page_save_queue
     except NameError: page_save_queue = []
+    try: page_held_saves
+    except NameError: page_held_saves = []
     new_text = new_text.strip()
     
     if old_text != None:
         old_text = old_text.strip()
         if old_text == new_text:
             pywikibot.output('\03{lightaqua}%s\03{default}: No changes necessary' % page.title())
+            if on_saved and not pywikibot.simulate: on_saved()
             return
         if pywikibot.simulate:
             pywikibot.output("\n\03{lightgreen}Simulation enabed\03{default} - showing difference instead of saving the page \03{lightaqua}%s\03{default}:" % page.title());
-            pywikibot.showDiff(old_text, new_text)
+            show_diff(page, old_text, new_text, summary)
             return
     else:
         if pywikibot.simulate:
@@ -804,26 +1158,220 @@ def queue_put(page, new_text, old_text = None, comment = None):
         elif lenN < lenO: more = '\03{lightred}%d\03{default}' % (lenN - lenO)
         else: more = '0'
         more = ' \03{default}Length difference: %s' % more
+    if hold:
+        pywikibot.output("\03{lightgreen}Holding page update \03{lightaqua}%s\03{default}%s" % (page.title(), more));
+        page_held_saves.append([page, new_text, comment, on_saved, rebuild, None])
+        return
     pywikibot.output("\03{lightgreen}Adding page update to queue \03{lightaqua}%s\03{default}%s" % (page.title(), more));
     
-    page_save_queue.append([page, new_text, comment])
-    
+    job = save_pool.submit(save_page, [page, new_text, comment, on_saved, rebuild, None])
+    page_save_queue.append(job)
+    return job
+def release_held_saves(after = None):
+    # Held updates are queued - they're skipped if the after save job fails
+    global page_save_queue, page_held_saves
+    try: page_held_saves
+    except NameError: page_held_saves = []
+    for rec in page_held_saves:
+        pywikibot.output("\03{lightgreen}Adding page update to queue \03{lightaqua}%s\03{default}" % rec[0].title());
+        rec[5] = after
+        page_save_queue.append(save_pool.submit(save_page, rec))
+    page_held_saves = []
+
+def save_page(rec, tries = 3):
+    page, text, comment, on_saved, rebuild, after = rec
+    # Save pool has one thread, so the after job is already done
+    if after != None:
+        try: saved = after.result()
+        except Exception: saved = False
+    if after != None and not saved:
+        pywikibot.output("\03{lightred}Skipping page \03{lightaqua}%s\03{default} - the update it depends on wasn't saved" % page.title());
+        return False
+    # compat only detects edit conflicts for text read with page.get() - text made from the page store is checked here
+    base = page_store.get(page)
+    if base != None: base = base[0]
+    for x in range(tries):
+        pywikibot.output("\03{lightgreen}Saving page \03{lightaqua}%s\03{default}" % page.title());
+        pywikibot.output("\03{lightyellow}Summary:\03{default} %s" % comment);
+        
+        start = time.time()
+        try:
+            if base != None and latest_revid(page) != base: raise pywikibot.EditConflict(u'Page %s has been edited since it was read' % page.title())
+            page.put(text, comment = comment)
+        except pywikibot.EditConflict:
+            if rebuild == None or x+1 == tries:
+                pywikibot.output("\03{lightred}Edit Conflict:\03{default} skipping");
+                return False
+            try: text = rebuild(page.get(force = True)).strip()
+            except TagsNotFound, e:
+                pywikibot.output("\03{lightred}Edit Conflict:\03{default} skipping - %s" % e);
+                return False
+            base = None
+            pywikibot.output("\03{lightred}Edit Conflict:\03{default} changes applied again to the latest revision");
+            continue
+        finally: profiler.add('save_page', time.time() - start)
+        page_store.forget(page)
+        run_state.saved(page_key(page))
+        if on_saved: on_saved()
+        return True
+    return False
 def run_put_queue():
     global page_save_queue
     try: page_save_queue
     except NameError: page_save_queue = []
         
-    pywikibot.output('\n\03{lightyellow}Running save queue with \03{lightaqua}%d\03{lightyellow} %s\03{default}' % (len(page_save_queue), ('elements','element')[len(page_save_queue)==1]))
-    for rec in page_save_queue:
-        pywikibot.output("\03{lightgreen}Saving page \03{lightaqua}%s\03{default}" % rec[0].title());
-        pywikibot.output("\03{lightyellow}Summary:\03{default} %s" % rec[2]);
-        
-        try: rec[0].put(rec[1], comment = rec[2])
-        except pywikibot.EditConflict:
-            pywikibot.output("\03{lightred}Edit Conflict:\03{default} skipping");
-            continue
+    pywikibot.output('\n\03{lightyellow}Waiting for save queue with \03{lightaqua}%d\03{lightyellow} %s\03{default}' % (len(page_save_queue), ('elements','element')[len(page_save_queue)==1]))
+    saved = 0
+    for job in page_save_queue:
+        if job.result(): saved += 1
+    if len(page_save_queue) != saved:
+        pywikibot.output('\03{lightred}%d\03{default} of \03{lightaqua}%d\03{default} pages not saved' % (len(page_save_queue) - saved, len(page_save_queue)))
+    all_saved = len(page_save_queue) == saved
     page_save_queue = []
+    return all_saved
+    
+def show_diff(page, old_text, new_text, summary = None):
+    # Prints a summary and at most args['difflines'] lines of the difference, the whole one goes to args['difffile']
+    global args, profiler
+    start = time.time()
+    old = old_text.split('\n')
+    new = new_text.split('\n')
+    codes = diff_opcodes(old, new)
+    removed = sum([i2 - i1 for tag, i1, i2, j1, j2 in codes if tag != 'equal'])
+    added = sum([j2 - j1 for tag, i1, i2, j1, j2 in codes if tag != 'equal'])
+    hunks = diff_hunks(codes, args['diffcontext'])
+    
+    pywikibot.output('\03{lightaqua}%s\03{default}: \03{lightgreen}+%d\03{default} \03{lightred}-%d\03{default} lines in %d %s%s' % (page.title(), added, removed, len(hunks), ('places','place')[len(hunks)==1], summary and ' - %s' % summary or ''))
+    lines = []
+    cut = False
+    for hunk in hunks:
+        if len(lines) >= args['difflines']:
+            cut = True
+            break
+        lines.append('\03{lightpurple}%s\03{default}' % diff_header(hunk))
+        for tag, i1, i2, j1, j2 in hunk:
+            if tag == 'equal': lines.extend(['  %s' % x for x in old[i1:i2]])
+            else:
+                lines.extend(['\03{lightred}- %s\03{default}' % x for x in old[i1:i2]])
+                lines.extend(['\03{lightgreen}+ %s\03{default}' % x for x in new[j1:j2]])
+    if lines: pywikibot.output('\n'.join(lines[:args['difflines']]))
+    if cut or len(lines) > args['difflines']:
+        pywikibot.output('\03{lightyellow}... difference cut%s\03{default}' % (args['difffile'] and ' - whole one is saved to %s' % args['difffile'] or ''))
+    
+    if args['difffile']:
+        f = codecs.open(args['difffile'], 'a', 'utf-8')
+        try:
+            f.write('--- %s\n+++ %s\n' % (page.title(), page.title()))
+            for hunk in hunks:
+                f.write('%s\n' % diff_header(hunk))
+                for tag, i1, i2, j1, j2 in hunk:
+                    if tag == 'equal': f.write(''.join([' %s\n' % x for x in old[i1:i2]]))
+                    else:
+                        f.write(''.join(['-%s\n' % x for x in old[i1:i2]]))
+                        f.write(''.join(['+%s\n' % x for x in new[j1:j2]]))
+        finally: f.close()
+    profiler.add('show_diff', time.time() - start)
+def diff_header(hunk):
+    return '@@ -%d,%d +%d,%d @@' % (hunk[0][1] + 1, hunk[-1][2] - hunk[0][1], hunk[0][3] + 1, hunk[-1][4] - hunk[0][3])
+def diff_opcodes(a, b):
+    # Line diff in the shape of SequenceMatcher.get_opcodes()
+    # Lines found once in both texts are matched first (patience diff) - it stays fast for pages with thousands of records
+    codes = []
+    diff_region(a, 0, len(a), b, 0, len(b), codes)
+    merged = []
+    for code in codes:
+        if code[1] == code[2] and code[3] == code[4]: continue
+        if merged and merged[-1][0] == code[0]:
+            last = merged.pop()
+            code = (code[0], last[1], code[2], last[3], code[4])
+        merged.append(code)
+    return merged
+def diff_region(a, alo, ahi, b, blo, bhi, codes):
+    start = alo
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        alo += 1
+        blo += 1
+    codes.append(('equal', start, alo, blo - (alo - start), blo))
+    end = ahi
+    while ahi > alo and bhi > blo and a[ahi-1] == b[bhi-1]:
+        ahi -= 1
+        bhi -= 1
+    suffix = ('equal', ahi, end, bhi, bhi + (end - ahi))
+    
+    if alo == ahi or blo == bhi:
+        codes.append(('replace', alo, ahi, blo, bhi))
+        codes.append(suffix)
+        return
     
+    # line: [count in a, count in b, index in a, index in b]
+    count = {}
+    for i in xrange(alo, ahi):
+        x = count.get(a[i])
+        if x == None: count[a[i]] = [1, 0, i, None]
+        else: x[0] += 1
+    for j in xrange(blo, bhi):
+        x = count.get(b[j])
+        if x == None: continue
+        x[1] += 1
+        x[3] = j
+    pairs = [(x[2], x[3]) for x in count.itervalues() if x[0] == 1 and x[1] == 1]
+    anchors = diff_anchors(sorted(pairs))
+    
+    if not anchors:
+        if (ahi - alo) * (bhi - blo) <= 250000:
+            for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi], autojunk = False).get_opcodes():
+                codes.append((tag, alo + i1, alo + i2, blo + j1, blo + j2))
+        else: codes.append(('replace', alo, ahi, blo, bhi))
+    else:
+        for i, j in anchors:
+            diff_region(a, alo, i, b, blo, j, codes)
+            codes.append(('equal', i, i + 1, j, j + 1))
+            alo, blo = i + 1, j + 1
+        diff_region(a, alo, ahi, b, blo, bhi, codes)
+    codes.append(suffix)
+def diff_anchors(pairs):
+    # Longest run of pairs increasing in both texts
+    tails = []
+    tail_index = []
+    prev = [None] * len(pairs)
+    for k, (i, j) in enumerate(pairs):
+        pos = bisect.bisect_left(tails, j)
+        if pos: prev[k] = tail_index[pos-1]
+        if pos == len(tails):
+            tails.append(j)
+            tail_index.append(k)
+        else:
+            tails[pos] = j
+            tail_index[pos] = k
+    anchors = []
+    k = None
+    if tail_index: k = tail_index[-1]
+    while k != None:
+        anchors.append(pairs[k])
+        k = prev[k]
+    anchors.reverse()
+    return anchors
+def diff_hunks(codes, context):
+    # Groups opcodes into hunks with context lines around changes - same as SequenceMatcher.get_grouped_opcodes()
+    if not codes: return []
+    codes = list(codes)
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = (tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2)
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = (tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context))
+    hunks = []
+    hunk = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > context * 2:
+            hunk.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            hunks.append(hunk)
+            hunk = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        hunk.append((tag, i1, i2, j1, j2))
+    if hunk and not (len(hunk) == 1 and hunk[0][0] == 'equal'): hunks.append(hunk)
+    return hunks
 def get_all_strikes(text):
     strikes = []
     basic = re.compile("\[\[w:c:(.*?)\|.*?\]\]")
@@ -837,62 +1385,173 @@ def get_all_strikes(text):
     return strikes
     
 def parse_categories(text):
-    basic = re.compile("\{\{\s*%s(.*?)\}\}"%re.escape(config['templates']['category_record'][0]), re.S)
     cats = {}
-    iter = basic.finditer(text)
-    while True:
-        try: match = iter.next().group(0)
-        except StopIteration: break
-        except AttributeError: continue
-        else:
-            info = template_params(match, 'category_record')
-            key = info['name'].lower()
-            cats[key] = {
-                'name': info['name']
-            }
+    for info in parse_templates(text, 'category_record'):
+        key = info['name'].lower()
+        cats[key] = {
+            'name': info['name']
+        }
     for cat in cats:
         for x in ['articles','artcount','images','imgcount']:
             cats[cat].setdefault(x,0)
     return cats
     
+def resolve_user_rights(usernames):
+    global site, json_cache, user_rights
+    missing = []
+    for name in set(usernames):
+        if name in user_rights: continue
+        # Groups are per wiki, so are cached rights
+        rights = json_cache.get('rights', site_key(name))
+        if rights != None: user_rights[name] = rights
+        else: missing.append(name)
+    
+    for i in range(0, len(missing), 50):
+        params = {
+            'action': 'query',
+            'list': 'users',
+            'ususers': '|'.join(missing[i:i+50]),
+            'usprop': 'groups',
+        }
+        for user in query.GetData(params, site)['query']['users']:
+            rights = {
+                'registered': 'missing' not in user and 'invalid' not in user,
+                'groups': user.get('groups', []),
+            }
+            user_rights[user['name']] = json_cache.set('rights', site_key(user['name']), rights)
 def allowed_edit(username):
-    global config
-    user = userlib.User(site,username);
+    global config, user_rights
+    if username not in user_rights: resolve_user_rights([username])
+    if username not in user_rights: return False
     
-    if not user.isRegistered(): return False
+    if not user_rights[username]['registered']: return False
     
-    groups = user.groups()
+    groups = user_rights[username]['groups']
     intersect = [i for i in groups if i in config['allowed_groups']]
     
     if len(intersect): return True
     if username in config['allowed_users']: return True
     return False
-def template_params(text, template):
-    
-    global tpl_cache
-    try: tpl_cache
-    except NameError: tpl_cache = {}
-    if template in tpl_cache:
-        rx = tpl_cache[template]['rx']
-        named = tpl_cache[template]['named']
-    else:
-        tpl_cache[template] = {}
-        tpl_cache[template]['rx'] = rx = prepare_template(template, rx = True)
-        tpl_cache[template]['named'] = named = prepare_template(template, rx = True, ret_named = True)
-    
-    info = {}
-    for reg in named:
-        m = reg.search(text)
-        if m == None: continue
-        info.update(m.groupdict())
-        
-    if rx:
-        m = rx.search(text)
-        if m != None: info.update(m.groupdict())
-    return info
-    
-def prepare_template(template, rx = False, ret_named = False, ret_unnamed = False):
-    global config
+def scan_templates(text):
+    # Single pass over text - returns (start, name, params) for every template, nested ones included
+    # params are shaped like results of str.partition('='): (key, '=', value) or (value, '', '') for unnamed ones
+    templates = []
+    stack = []
+    for token in template_tokens.finditer(text):
+        flat = token.group(1)
+        if flat != None:
+            # Template without anything nested in it - the common case for records
+            parts = flat.split('|')
+            templates.append((token.start(), parts[0].strip(), [part.partition('=') for part in parts[1:]]))
+            continue
+        tok = token.group(0)
+        if tok in ('{{', '[[', '{{{'):
+            stack.append({'open': tok, 'start': token.start(), 'parts': [], 'part': token.end(), 'eq': None, 'tokens': []})
+        elif tok in ('}}', ']]', '}}}'):
+            opener = {'}}': '{{', ']]': '[[', '}}}': '{{{'}[tok]
+            depth = len(stack) - 1
+            while depth >= 0 and stack[depth]['open'] != opener: depth -= 1
+            if depth < 0: continue
+            frame = stack[depth]
+            # Separators found inside links or parameters left unclosed belong to the enclosing frame
+            for unclosed in stack[depth+1:]:
+                for x in unclosed['tokens']: template_separator(frame, x)
+            del stack[depth:]
+            if opener != '{{': continue
+            frame['parts'].append((frame['part'], frame['eq'], token.start()))
+            
+            name = text[frame['parts'][0][0]:frame['parts'][0][2]].strip()
+            params = []
+            for start, eq, end in frame['parts'][1:]:
+                if eq == None: params.append((text[start:end], '', ''))
+                else: params.append((text[start:eq], '=', text[eq+1:end]))
+            templates.append((frame['start'], name, params))
+        elif stack:
+            template_separator(stack[-1], token)
+    templates.sort(key = lambda x: x[0])
+    return templates
+def template_separator(frame, token):
+    if frame['open'] != '{{':
+        frame['tokens'].append(token)
+    elif token.group(0) == '|':
+        frame['parts'].append((frame['part'], frame['eq'], token.start()))
+        frame['part'] = token.end()
+        frame['eq'] = None
+    elif frame['eq'] == None and frame['parts']:
+        frame['eq'] = token.start()
+template_tokens = re.compile(r'\{\{(?!\{)([^{}\[\]]*)\}\}|\{\{\{|\}\}\}|\{\{|\}\}|\[\[|\]\]|\||=')
+def compile_templates():
+    # Everything about templates is prepared once, right after the config is loaded
+    global config, tpl_cache, tpl_render
+    tpl_cache = {}
+    tpl_render = {}
+    for template in config['templates']:
+        compile_template(template)
+        prepare_template(template)
+def compile_template(template):
+    # Turns config['templates'][template] into regexes matching values of single parameters
+    global config, tpl_cache
+    if template in tpl_cache: return tpl_cache[template]
+    
+    definition = config['templates'][template]
+    compiled = {
+        'name': definition[0].strip(),
+        'unnamed': [],
+        'named': {},
+    }
+    for param in definition[1:]:
+        if param.find('=') == -1: compiled['unnamed'].append(compile_template_value(param))
+        else:
+            key, value = param.split('=', 1)
+            compiled['named'][key.strip()] = compile_template_value(value)
+    tpl_cache[template] = compiled
+    return compiled
+def compile_template_value(value):
+    # Values made of a single placeholder are returned as its name - they don't need a regex
+    parts = re.split(r'%\((.*?)\)[-#0 +]*\d*(?:\.\d+)?[a-z]', value.strip())
+    if len(parts) == 3 and not parts[0] and not parts[2]: return parts[1]
+    rx = []
+    seen = []
+    for i, part in enumerate(parts):
+        if i % 2 == 0: rx.append(re.sub(r'(\\\s)+', r'\s*', re.escape(part)))
+        elif part in seen: rx.append('(?P=%s)' % part)
+        else:
+            seen.append(part)
+            rx.append('(?P<%s>.*?)' % part)
+    return re.compile('^\s*%s\s*$' % ''.join(rx), re.S)
+def parse_templates(text, template):
+    # Returns parameters of every occurrence of template in text (as dicts, in order of appearance)
+    global profiler
+    began = time.time()
+    compiled = compile_template(template)
+    named = compiled['named']
+    unnamed = compiled['unnamed']
+    records = []
+    for start, name, params in scan_templates(text):
+        if name != compiled['name']: continue
+        info = {}
+        position = 0
+        for key, eq, value in params:
+            if eq: rx = named.get(key.strip())
+            elif position < len(unnamed):
+                rx = unnamed[position]
+                value = key
+                position += 1
+            else: continue
+            if rx == None: continue
+            
+            if isinstance(rx, basestring): info[rx] = value.strip()
+            else:
+                m = rx.match(value)
+                if m != None: info.update(m.groupdict())
+        records.append(info)
+    profiler.add('parse_templates', time.time() - began)
+    return records
+def prepare_template(template):
+    # Returns format string rendering the template - to be used with "template % record"
+    global config, tpl_render
+    if template in tpl_render: return tpl_render[template]
+    name = template
     template = config['templates'][template]
     named = []
     unnamed = []
@@ -901,41 +1560,16 @@ def prepare_template(template, rx = False, ret_named = False, ret_unnamed = Fals
         if param.find('=') == -1: unnamed.append(param)
         else: named.append(param)
     
-    if rx and ret_named:
-        for i, nam in enumerate(named):
-            m = re.findall(r"%[^\(]*\((.*?)\)", named[i])
-            d = {}
-            for x in m:
-                d[x] = '(?P<%s>[^\|]*?)'%x
-            named[i] = nam % d
-            named[i] = re.sub(r'^(.*?)\s*=\s*(.*?)\s*$', r'^\s*\|\s*\1\s*\=\s*\2\s*$', named[i])
-            named[i] = re.compile(named[i], re.M)
-    if ret_named: return named
-    if ret_unnamed: return unnamed
-    
-    if rx and len(unnamed) == 0: return False
-    if rx: join = '\s*\|\s*'
-    else: join = ' | '
-    
+    join = ' | '
     if len(unnamed):
-        unnamed = join + join.join(unnamed)
-        if not rx: unnamed = unnamed + ' '
+        unnamed = join + join.join(unnamed) + ' '
     else: unnamed = ''
     
-    if rx:
-        tpl = "^{{\s*%s%s%s" % (re.escape(template[0]), unnamed, ('\s*$','\s*}}')[len(named)==0])
-        m = re.findall(r"%[\(]*\((.*?)\)", tpl)
-        d = {}
-        for x in m:
-            d[x] = '(?P<%s>.*?)'%x
-        tpl = tpl % d
-        return re.compile(tpl, re.M)
-        
-    
     if len(named): named = '\n| ' + '\n| '.join(named) + '\n'
     else: named = ''
     
-    return "{{%s%s%s}}" % (template[0], unnamed, named)
+    tpl_render[name] = "{{%s%s%s}}" % (template[0], unnamed, named)
+    return tpl_render[name]
     
 def put_between(text, tag, what):
     start = text.find(tag[0])
@@ -970,6 +1604,27 @@ def initialize():
     args['saveconfig'] = False
     args['loadconfig'] = False
     args['revisionday'] = None
+    args['workers'] = 10
+    args['cache'] = 'cache'
+    args['stale'] = False
+    args['archive'] = 'archive'
+    args['putthrottle'] = None
+    args['maxlag'] = None
+    args['profile'] = None
+    args['incremental'] = False
+    args['stats'] = stats_settings['backend']
+    args['shard'] = None
+    args['snapshot'] = 'snapshot.json.gz'
+    args['state'] = 'state.json'
+    args['offline'] = None
+    args['diffcontext'] = 3
+    args['difflines'] = 100
+    args['difffile'] = None
+    args['shards'] = 'shards'
+    args['merge'] = False
+    args['shardage'] = 24
+    args['fullrefresh'] = 4
+    args['cprofile'] = None
 
     for arg in pywikibot.handleArgs():
         if   arg == '-clean':                args['clean'] = True
@@ -980,21 +1635,64 @@ def initialize():
         elif arg.startswith('-saveconfig'):  args['saveconfig'] = arg[12:] or 'config.json'
         elif arg.startswith('-loadconfig'):  args['loadconfig'] = arg[12:] or 'config.json'
         elif arg.startswith('-revisionday:'):args['revisionday'] = datetime.datetime.strptime(arg[13:], u'%Y-%m-%d').date()
+        elif arg.startswith('-workers:'):    args['workers'] = max(1, int(arg[9:]))
+        elif arg.startswith('-cache:'):      args['cache'] = arg[7:]
+        elif arg == '-nocache':              args['cache'] = None
+        elif arg == '-stale':                args['stale'] = True
+        elif arg.startswith('-archive:'):    args['archive'] = arg[9:]
+        elif arg == '-noarchive':            args['archive'] = None
+        elif arg.startswith('-putthrottle:'):args['putthrottle'] = float(arg[13:])
+        elif arg.startswith('-maxlag:'):     args['maxlag'] = int(arg[8:])
+        elif arg.startswith('-profile'):     args['profile'] = arg[9:] or 'profile.json'
+        elif arg.startswith('-cprofile'):    args['cprofile'] = arg[10:] or 'profile.pstats'
+        elif arg == '-incremental':          args['incremental'] = True
+        elif arg.startswith('-stats:'):      args['stats'] = arg[7:]
+        elif arg.startswith('-fullrefresh:'):args['fullrefresh'] = max(1, int(arg[13:]))
+        elif arg.startswith('-shard:'):      args['shard'] = arg[7:]
+        elif arg.startswith('-shards:'):     args['shards'] = arg[8:]
+        elif arg == '-merge':                args['merge'] = True
+        elif arg.startswith('-shardage:'):   args['shardage'] = max(0, int(arg[10:]))
+        elif arg.startswith('-snapshot:'):   args['snapshot'] = arg[10:]
+        elif arg == '-nosnapshot':           args['snapshot'] = None
+        elif arg.startswith('-state:'):      args['state'] = arg[7:]
+        elif arg == '-nostate':              args['state'] = None
+        elif arg.startswith('-offline'):     args['offline'] = arg[9:] or 'snapshot.json.gz'
+        elif arg.startswith('-diffcontext:'):args['diffcontext'] = max(0, int(arg[13:]))
+        elif arg.startswith('-difflines:'):  args['difflines'] = max(0, int(arg[11:]))
+        elif arg.startswith('-difffile'):    args['difffile'] = arg[10:] or 'simulate.diff'
     
     #log = 'wikia_logs%s/%s.txt' % (('','_sim')[pywikibot.simulate], datetime.datetime.now().isoformat('_').replace(':', '-'))
     #pywikibot.setLogfileStatus(True, log)
     
+    if args['shard'] != None:
+        try: args['shard'] = tuple([int(x) for x in args['shard'].split('/')])
+        except ValueError: args['shard'] = ()
+    if args['shard'] != None and (len(args['shard']) != 2 or not 1 <= args['shard'][0] <= args['shard'][1]):
+        pywikibot.output('\n\n\03{lightred}FATAL ERROR:\03{default} -shard has to be given as i/N, where 1 <= i <= N')
+        return exit('InvalidArgs')
+    
+    if args['stats'] not in stats_backends:
+        pywikibot.output('\n\n\03{lightred}FATAL ERROR:\03{default} Unknown stats backend \03{lightaqua}%s\03{default} - use one of: %s' % (args['stats'], ', '.join(sorted(stats_backends))))
+        return exit('InvalidArgs')
+    
+    if args['offline'] and not os.path.isfile(args['offline']):
+        pywikibot.output('\n\n\03{lightred}FATAL ERROR:\03{default} Stats snapshot \03{lightaqua}%s\03{default} does not exist' % args['offline'])
+        return exit('InvalidArgs')
+    if args['difffile']: codecs.open(args['difffile'], 'w', 'utf-8').close()
+    
     args['extended_bak'] = args['extended']
     for arg in sys.argv[1:]:
         if arg.startswith('-family:'): force_family = arg[8:]
         elif arg.startswith('-lang:'): force_lang = arg[6:]
     
-    global json_cache
-    json_cache = {
-        'info': {},
-        'stats': {},
-        'admins': {},
-    }
+    global pool, save_pool, http_client, flights
+    pool = WorkerPool(args['workers'])
+    flights = SingleFlight()
+    # Pages are saved one at a time, but in the background while the rest is being computed
+    save_pool = WorkerPool(1)
+    http_client = HTTPClient(http_settings)
+    if args['putthrottle'] != None: pywikibot.put_throttle.setDelay(args['putthrottle'])
+    if args['maxlag'] != None: pywikibot.config.maxlag = args['maxlag']
     global site, current_time
     site = pywikibot.getSite(force_lang, force_family)
     
@@ -1011,6 +1709,23 @@ def initialize():
     if args['loadconfig'] and loadchoice == 'y': load_config(args['loadconfig'])
     
     check_config()
+    compile_templates()
+    
+    global json_cache
+    if args['cache']: json_cache = JSONCache(os.path.join(args['cache'], 'json.sqlite'), config['cache_ttl'], stale = args['stale'])
+    else: json_cache = JSONCache(None, config['cache_ttl'])
+    http_client.cache = json_cache
+    global stats_backend
+    stats_backend = stats_backends[args['stats']](stats_settings)
+    if args['incremental'] and not args['cache']:
+        pywikibot.output('\03{lightyellow}Incremental mode needs the persistent JSON cache\03{default} - every wiki will be fetched in full')
+    
+    global ranking_archive, user_rights, shard_results, run_state, page_store
+    ranking_archive = RankingArchive(args['archive'])
+    page_store = PageStore()
+    run_state = RunState(args['state'])
+    user_rights = {}
+    shard_results = None
     
     if args['saveconfig']: dump_config(args['saveconfig'])
     
@@ -1058,6 +1773,470 @@ class JSONError(Exception):
     def __str__(self):
         return self.value
 
+class Record(object):
+    # Compact replacement for dicts with a fixed set of keys - still works with "template % record", dict(record) and qs()
+    __slots__ = []
+    def __init__(self, **fields):
+        for key in self.__slots__: setattr(self, key, fields.get(key))
+    def __getitem__(self, key):
+        try: return getattr(self, key)
+        except (AttributeError, TypeError): raise KeyError(key)
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+    def __contains__(self, key):
+        return key in self.__slots__
+    def keys(self):
+        return list(self.__slots__)
+    def setdefault(self, key, value):
+        if self[key] == None: self[key] = value
+        return self[key]
+class WikiRecord(Record):
+    __slots__ = ['code', 'name', 'display', 'visible', 'address', 'categories', 'articles', 'images', 'users', 'admins']
+class RankRecord(Record):
+    __slots__ = ['code', 'name', 'count']
+
+class Job(object):
+    def __init__(self, func, item):
+        self.func = func
+        self.item = item
+        self.value = None
+        self.error = None
+        self.done = threading.Event()
+    def run(self):
+        try: self.value = self.func(self.item)
+        except Exception: self.error = sys.exc_info()
+        self.done.set()
+    def result(self):
+        # Waiting in short steps keeps KeyboardInterrupt working on Python 2
+        while not self.done.wait(0.5): pass
+        if self.error: raise self.error[0], self.error[1], self.error[2]
+        return self.value
+class WorkerPool(object):
+    def __init__(self, workers):
+        self.queue = Queue.Queue()
+        self.threads = []
+        for x in range(max(1, workers)):
+            thread = threading.Thread(target = self.worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+    def worker(self):
+        while True:
+            job = self.queue.get()
+            if job == None: break
+            job.run()
+    def submit(self, func, item):
+        job = Job(func, item)
+        self.queue.put(job)
+        return job
+    def map(self, func, items):
+        # Jobs are returned in the order of items - results are read with job.result()
+        return [(item, self.submit(func, item)) for item in items]
+    def close(self):
+        for thread in self.threads: self.queue.put(None)
+        for thread in self.threads: thread.join()
+        self.threads = []
+class SingleFlight(object):
+    # Calls with the same key share one result for the whole run - also while it's still being fetched
+    # Failures are only shared with calls waiting for them, later calls try again
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}
+    def do(self, key, func):
+        with self.lock:
+            job = self.jobs.get(key)
+            owner = job == None
+            if owner: job = self.jobs[key] = Job(lambda x: func(), key)
+        if owner:
+            job.run()
+            if job.error:
+                with self.lock:
+                    if self.jobs.get(key) is job: del self.jobs[key]
+        return job.result()
+class Profiler(object):
+    # Collects timings for -profile - cheap enough to be always on, the report is only written with -profile
+    # Latency histogram buckets are upper bounds in milliseconds
+    buckets = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = []
+        self.endpoints = {}
+        self.helpers = {}
+    def cpu(self):
+        # CPU time of the whole process - worker threads included
+        times = os.times()
+        return times[0] + times[1]
+    def peak_rss(self):
+        if resource == None: return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    @contextlib.contextmanager
+    def phase(self, name):
+        wall = time.time()
+        cpu = self.cpu()
+        requests = sum([x['count'] for x in self.endpoints.values()])
+        try: yield
+        finally:
+            self.phases.append({
+                'name': name,
+                'wall': time.time() - wall,
+                'cpu': self.cpu() - cpu,
+                'requests': sum([x['count'] for x in self.endpoints.values()]) - requests,
+                'peak_rss_kb': self.peak_rss(),
+            })
+    def request(self, url, seconds, ok):
+        match = re.search(r'[?&](list|meta|prop)=([^&]*)', url)
+        if match: endpoint = '%s=%s' % match.groups()
+        else: endpoint = urlparse.urlsplit(url).path
+        ms = seconds * 1000
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0, 'histogram': [0] * (len(self.buckets) + 1)})
+            stats['count'] += 1
+            if not ok: stats['errors'] += 1
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            i = 0
+            while i < len(self.buckets) and ms > self.buckets[i]: i += 1
+            stats['histogram'][i] += 1
+    def add(self, name, seconds):
+        with self.lock:
+            stats = self.helpers.setdefault(name, {'calls': 0, 'total': 0.0})
+            stats['calls'] += 1
+            stats['total'] += seconds
+    def report(self):
+        labels = ['<=%dms' % x for x in self.buckets] + ['>%dms' % self.buckets[-1]]
+        endpoints = {}
+        for endpoint, stats in self.endpoints.items():
+            endpoints[endpoint] = dict(stats, average = stats['total'] / stats['count'], histogram = zip(labels, stats['histogram']))
+        return {
+            'started': datetime.datetime.fromtimestamp(self.started).isoformat(' '),
+            'wall': time.time() - self.started,
+            'cpu': self.cpu(),
+            'peak_rss_kb': self.peak_rss(),
+            'phases': self.phases,
+            'http': endpoints,
+            'helpers': self.helpers,
+        }
+    def dump(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory): os.makedirs(directory)
+        f = open(path, 'w')
+        try: json.dump(self.report(), f, indent = 2, sort_keys = True)
+        finally: f.close()
+class SiteinfoStats(object):
+    # Counts from one siteinfo request per wiki
+    def __init__(self, settings):
+        self.settings = settings
+    def prefetch(self, codes):
+        pass
+    def statinfo(self, address):
+        return get_wiki_siteinfo(address)
+class CentralStats(SiteinfoStats):
+    # Counts of many wikis per request from the central Wikis/Details API - city ids come from siteinfo (see get_city_id)
+    # Wikis without known id, missing from the answer or from a failed batch are fetched from siteinfo
+    def __init__(self, settings):
+        SiteinfoStats.__init__(self, settings)
+        self.stats = {}
+    def prefetch(self, codes):
+        global json_cache
+        codes_by_id = {}
+        for code in codes:
+            try: codes_by_id[int(json_cache.get('ids', code))] = code
+            except (TypeError, ValueError): continue
+        ids = sorted(codes_by_id)
+        batch = self.settings['batch']
+        for chunk, job in pool.map(self.fetch, [ids[i:i+batch] for i in range(0, len(ids), batch)]):
+            try: items = job.result()
+            except JSONError, e:
+                pywikibot.output('\03{lightred}Central stats request for %d wikis failed\03{default}: %s - they will be fetched from siteinfo' % (len(chunk), e))
+                continue
+            for item in items.values():
+                try: code = codes_by_id.get(int(item['id']))
+                except (KeyError, TypeError, ValueError): continue
+                if code == None or 'stats' not in item: continue
+                stats = {'articles': item['stats']['articles'], 'images': item['stats']['images'], 'activeusers': item['stats']['activeUsers']}
+                self.stats[code] = json_cache.set('stats', code, stats)
+        pywikibot.output('\03{lightyellow}Central stats\03{default}: %d of %d wikis in %d %s, %d without known id' % (len(self.stats), len(codes), (len(ids) + batch - 1) / batch, ('requests','request')[len(ids) <= batch], len(codes) - len(ids)))
+    def fetch(self, ids):
+        url = 'http://%s/api/v1/Wikis/Details?ids=%s' % (self.settings['central_host'], ','.join([str(x) for x in ids]))
+        return json_from_url(url)['items']
+    def statinfo(self, address):
+        if address not in self.stats: return get_wiki_siteinfo(address)
+        return {'info': get_wiki_info(address), 'stats': self.stats[address]}
+stats_backends = {
+    'siteinfo': SiteinfoStats,
+    'central': CentralStats,
+}
+class PageStore(object):
+    # Latest revision of pages read in bulk for this run - {title: (revid, timestamp, text)}, None for missing pages
+    def __init__(self):
+        self.pages = {}
+        self.lock = threading.Lock()
+    def preload(self, pages, batch = 50):
+        global site
+        titles = []
+        for page in pages:
+            if page.title() not in self.pages and page.title() not in titles: titles.append(page.title())
+        for i in range(0, len(titles), batch):
+            params = {
+                'action': 'query',
+                'prop': 'revisions',
+                'titles': '|'.join(titles[i:i+batch]),
+                'rvprop': 'ids|timestamp|content',
+            }
+            data = query.GetData(params, site)
+            with self.lock:
+                for info in data['query']['pages'].values():
+                    if 'missing' in info: self.pages[info['title']] = None
+                    # Texts left out over the response size limit are read one by one later
+                    elif info.get('revisions') and '*' in info['revisions'][0]:
+                        rev = info['revisions'][0]
+                        self.pages[info['title']] = (rev['revid'], rev['timestamp'], rev['*'])
+        pywikibot.output('\03{lightyellow}Preloaded\03{default} %d of %d pages' % (len([x for x in titles if x in self.pages]), len(titles)))
+    def known(self, page):
+        return page.title() in self.pages
+    def get(self, page):
+        return self.pages.get(page.title())
+    def forget(self, page):
+        with self.lock: self.pages.pop(page.title(), None)
+class RunState(object):
+    # Time of the last successful save of every page (UTC, like timestamps in page history) - {page key: timestamp}
+    def __init__(self, path):
+        self.path = path
+        self.pages = {}
+        self.lock = threading.Lock()
+        if not path: return
+        try:
+            f = open(path)
+            try: self.pages = json.load(f)
+            finally: f.close()
+        except (IOError, ValueError): pass
+    def last_save(self, key):
+        if key not in self.pages: return None
+        return datetime.datetime.strptime(self.pages[key], '%Y-%m-%dT%H:%M:%SZ')
+    def saved(self, key):
+        if not self.path: return
+        with self.lock:
+            self.pages[key] = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory): os.makedirs(directory)
+            f = open(self.path + '.tmp', 'w')
+            try: json.dump(self.pages, f, indent = 1, sort_keys = True)
+            finally: f.close()
+            if os.path.exists(self.path): os.remove(self.path)
+            os.rename(self.path + '.tmp', self.path)
+class RankingArchive(object):
+    # One gzipped JSON file per day: {page title: {wiki code: place}}
+    def __init__(self, directory):
+        self.directory = directory
+        self.days = {}
+        # Rankings are stored from the save thread while others are being looked up
+        self.lock = threading.RLock()
+    def path(self, day):
+        return os.path.join(self.directory, '%s.json.gz' % day.isoformat())
+    def dates(self):
+        if not self.directory or not os.path.isdir(self.directory): return []
+        dates = []
+        for name in os.listdir(self.directory):
+            try: dates.append(datetime.datetime.strptime(name, '%Y-%m-%d.json.gz').date())
+            except ValueError: continue
+        return sorted(dates)
+    def load(self, day):
+        with self.lock:
+            if day not in self.days:
+                try:
+                    f = gzip.open(self.path(day), 'rb')
+                    try: self.days[day] = json.load(f)
+                    finally: f.close()
+                except (IOError, ValueError): self.days[day] = {}
+            return self.days[day]
+    def find(self, title, day = None):
+        # Without a day the newest snapshot is used, otherwise the first one made on that day or later
+        if day == None: dates = reversed(self.dates())
+        else: dates = [x for x in self.dates() if x >= day]
+        for x in dates:
+            with self.lock:
+                snapshot = self.load(x)
+                if title in snapshot: return snapshot[title]
+        return None
+    def store(self, title, ranking, day):
+        if not self.directory: return
+        with self.lock:
+            if not os.path.isdir(self.directory): os.makedirs(self.directory)
+            snapshot = self.load(day)
+            snapshot[title] = ranking
+            tmp = self.path(day) + '.tmp'
+            f = gzip.open(tmp, 'wb')
+            try: json.dump(snapshot, f, separators = (',', ':'))
+            finally: f.close()
+            if os.path.exists(self.path(day)): os.remove(self.path(day))
+            os.rename(tmp, self.path(day))
+class HTTPClient(object):
+    def __init__(self, settings, cache = None):
+        # cache keeps responses for conditional requests (see JSONCache.get_response)
+        self.settings = settings
+        self.cache = cache
+        self.local = threading.local()
+    def connections(self):
+        # httplib connections can't be shared between threads - each worker keeps its own
+        try: return self.local.connections
+        except AttributeError:
+            self.local.connections = collections.OrderedDict()
+            return self.local.connections
+    def connect(self, scheme, host):
+        connections = self.connections()
+        if (scheme, host) in connections:
+            conn = connections.pop((scheme, host))
+        else:
+            if scheme == 'https': conn = httplib.HTTPSConnection(host, timeout = self.settings['connect_timeout'])
+            else: conn = httplib.HTTPConnection(host, timeout = self.settings['connect_timeout'])
+            conn.connect()
+            conn.sock.settimeout(self.settings['read_timeout'])
+        connections[(scheme, host)] = conn
+        while len(connections) > self.settings['connections']:
+            connections.popitem(last = False)[1].close()
+        return conn
+    def drop(self, scheme, host):
+        conn = self.connections().pop((scheme, host), None)
+        if conn != None: conn.close()
+    def fetch(self, url, redirects = 5, headers = {}):
+        for x in range(redirects + 1):
+            parts = urlparse.urlsplit(url)
+            if self.settings['proxy'] and parts.scheme == 'http':
+                host = self.settings['proxy']
+                path = url
+            else:
+                host = parts.netloc
+                path = parts.path or '/'
+                if parts.query: path += '?' + parts.query
+            try:
+                conn = self.connect(parts.scheme, host)
+                conn.request('GET', path, headers = dict(headers, **{'Host': parts.netloc, 'Accept-Encoding': 'gzip', 'User-Agent': 'Ranking-bot (pywikibot)'}))
+                response = conn.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                self.drop(parts.scheme, host)
+                raise
+            if response.will_close: self.drop(parts.scheme, host)
+            
+            if (response.getheader('content-encoding') or '').lower() == 'gzip':
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('location'):
+                url = urlparse.urljoin(url, response.getheader('location'))
+                continue
+            return (response, body)
+        raise JSONError('Too many redirects')
+    def delay(self, attempt, response = None):
+        if response != None:
+            try: return min(float(response.getheader('retry-after')), self.settings['max_backoff'])
+            except (TypeError, ValueError): pass
+        delay = min(self.settings['backoff'] * 2 ** attempt, self.settings['max_backoff'])
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+    def get(self, url, tries = None, revalidate = False):
+        # With revalidate the response is stored with its validators and later requests for the same URL are conditional
+        # "304 Not Modified" is answered with the stored body
+        if tries == None: tries = self.settings['tries']
+        if isinstance(url, unicode): url = url.encode('utf-8')
+        stored = None
+        headers = {}
+        if revalidate and self.cache != None:
+            key = re.sub(r'&maxlag=\d+', '', url)
+            stored = self.cache.get_response(key)
+        if stored != None:
+            if stored['etag']: headers['If-None-Match'] = stored['etag']
+            if stored['modified']: headers['If-Modified-Since'] = stored['modified']
+        for attempt in range(tries):
+            response = None
+            try:
+                response, body = self.fetch(url, headers = headers)
+            except httplib.InvalidURL: raise
+            except socket.gaierror, e:
+                raise JSONError('URLError: %s' % e)
+            except (httplib.HTTPException, socket.error):
+                pass
+            else:
+                lagged = response.getheader('mediawiki-api-error') == 'maxlag'
+                if response.status == 304 and stored != None:
+                    self.cache.touch_response(key)
+                    return stored['body']
+                if response.status == 200 and not lagged:
+                    etag = response.getheader('etag')
+                    modified = response.getheader('last-modified')
+                    if revalidate and self.cache != None and (etag or modified): self.cache.set_response(key, etag, modified, body)
+                    return body
+                if response.status not in (200, 429, 500, 502, 503, 504): raise JSONError('HTTP error: %d' % response.status)
+            if attempt + 1 < tries: time.sleep(self.delay(attempt, response))
+        raise JSONError('No response')
+class JSONCache(object):
+    def __init__(self, path, ttl, stale = False):
+        self.ttl = ttl
+        self.stale = stale
+        self.memory = {}
+        self.refreshing = {}
+        self.lock = threading.Lock()
+        self.db = None
+        if path == None: return
+        
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory): os.makedirs(directory)
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS cache (kind TEXT, key TEXT, value TEXT, fetched REAL, PRIMARY KEY (kind, key))')
+        # Raw responses with their validators (ETag / Last-Modified) for conditional requests
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, etag TEXT, modified TEXT, body BLOB, fetched REAL)')
+        self.db.execute('DELETE FROM responses WHERE fetched < ?', (time.time() - self.ttl['responses'],))
+        self.db.commit()
+    def get(self, kind, key, refresh = None):
+        with self.lock:
+            if (kind, key) in self.memory: return self.memory[(kind, key)]
+            if self.db == None: return None
+            row = self.db.execute('SELECT value, fetched FROM cache WHERE kind = ? AND key = ?', (kind, key)).fetchone()
+        if row == None: return None
+        
+        value = json.loads(row[0])
+        if time.time() - row[1] > self.ttl[kind]:
+            if not self.stale or refresh == None: return None
+            with self.lock:
+                if (kind, key) not in self.refreshing:
+                    self.refreshing[(kind, key)] = pool.submit(lambda x: refresh(), key)
+        with self.lock:
+            self.memory[(kind, key)] = value
+        return value
+    def set(self, kind, key, value):
+        with self.lock:
+            self.memory[(kind, key)] = value
+            if self.db != None:
+                self.db.execute('INSERT OR REPLACE INTO cache (kind, key, value, fetched) VALUES (?, ?, ?, ?)', (kind, key, json.dumps(value), time.time()))
+                self.db.commit()
+        return value
+    def get_response(self, url):
+        # Not kept in memory - they're only needed once per run
+        if self.db == None: return None
+        with self.lock:
+            row = self.db.execute('SELECT etag, modified, body FROM responses WHERE url = ?', (url,)).fetchone()
+        if row == None: return None
+        return {'etag': row[0], 'modified': row[1], 'body': str(row[2])}
+    def set_response(self, url, etag, modified, body):
+        if self.db == None: return
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO responses (url, etag, modified, body, fetched) VALUES (?, ?, ?, ?, ?)', (url, etag, modified, sqlite3.Binary(body), time.time()))
+            self.db.commit()
+    def touch_response(self, url):
+        if self.db == None: return
+        with self.lock:
+            self.db.execute('UPDATE responses SET fetched = ? WHERE url = ?', (time.time(), url))
+            self.db.commit()
+    def close(self):
+        # Stale entries refreshed in the background are only used on the next run
+        for job in self.refreshing.values():
+            while not job.done.wait(0.5): pass
+        self.refreshing = {}
+        if self.db == None: return
+        with self.lock:
+            self.db.close()
+            self.db = None
+
 def console_table(names, widths = []):
     global console_settings_cache
     try:console_settings_cache
@@ -1105,26 +2284,19 @@ def console_end(flag = False):
         pywikibot.output(console_settings_cache['sep'])
         if not flag:
             console_settings_cache = {}
-    except KeyError: return
+    except (KeyError, NameError): return
         
-def json_from_url(url, tries=5):
-    from socket import error as socket_error
-    response = ''
-    x = 0
-    while x<tries:
-        try:
-            if response: break
-            response = urllib2.urlopen(url)
-        except urllib2.HTTPError:
-            x += 1
-        except socket_error:
-            x += 1
-        except urllib2.URLError, e:
-            raise JSONError('URLError: %s' % unicode(e.reason))
-            
-    if not response: raise JSONError('No response')
+def json_from_url(url, tries=None, revalidate=False):
+    global http_client, http_settings, profiler
+    if url.find('api.php') >= 0 and url.find('maxlag=') == -1:
+        url += '&maxlag=%d' % http_settings['maxlag']
     
-    response = response.read()
+    start = time.time()
+    ok = False
+    try:
+        response = http_client.get(url, tries, revalidate)
+        ok = True
+    finally: profiler.request(url, time.time() - start, ok)
     
     if response == '': raise JSONError('Empty response')
     if response.find('page-Special_CloseWiki') >= 0: raise InvalidWiki(url,True)
@@ -1136,82 +2308,179 @@ def json_from_url(url, tries=5):
         raise JSONError('No JSON object could be decoded')
         
     return obj
-def get_wiki_admins(address, active=False, useCache=True, useInfoCache=True):
+def get_wiki_admins(address, active=False, useCache=True):
+    global json_cache, flights
+    kind = ('admins', 'active')[active]
+    if useCache:
+        admins = json_cache.get(kind, address, refresh = lambda: get_wiki_admins(address, active = active, useCache = False))
+        if admins != None: return admins
+    return flights.do((address, kind), lambda: fetch_wiki_admins(address, active, useCache))
+def fetch_wiki_admins(address, active, useCache):
     global json_cache, args, config
-    if useCache and address in json_cache['admins']: admins = json_cache['admins'][address]
-    else:
-        if args['extended']: pywikibot.output('\nJSON: Fetching admins for [%s]' % address)
-        url = 'http://%s.wikia.com/api.php?action=query&list=allusers&auprop=editcount&augroup=sysop&format=json' % address
-        admins = json_from_url(url)['query']['allusers']
-        url = 'http://%s.wikia.com/api.php?action=query&list=allusers&auprop=editcount&augroup=bureaucrat&format=json' % address
-        bureaucrats = json_from_url(url)['query']['allusers']
-        for user in bureaucrats:
-            if user not in admins:
-                admins.append(user)
     if not active:
-        json_cache['admins'][address] = admins
-        return json_cache['admins'][address]
-    now = datetime.datetime.strptime(get_wiki_info(address, useCache = useInfoCache)['time'], u'%Y-%m-%dT%H:%M:%SZ')
-    activeadmins = []
-    for admin in admins:
-        if admin['editcount'] == 0: continue
-        url = 'http://%s.wikia.com/api.php?action=query&list=usercontribs&uclimit=1&ucuser=%s&ucprop=timestamp&format=json' % (address, urllib2.quote(admin['name'].encode('utf-8')))
-        try:
-            delta = now-datetime.datetime.strptime(json_from_url(url)['query']['usercontribs'][0]['timestamp'], u'%Y-%m-%dT%H:%M:%SZ')
-        except IndexError:
-            continue
-        if delta.days >= config['admin_active_days']: continue
-        activeadmins.append(admin)
-    return activeadmins
-def get_wiki_info(address, useCache=True):
+        if args['extended']: pywikibot.output('\nJSON: Fetching admins for [%s]' % address)
+        url = 'http://%s.wikia.com/api.php?action=query&list=allusers&auprop=editcount&augroup=sysop|bureaucrat&aulimit=max&format=json' % address
+        admins = []
+        seen = set()
+        for user in json_query_all(url, 'allusers'):
+            if user['name'] in seen: continue
+            seen.add(user['name'])
+            admins.append(pick(user, siteinfo_fields['user']))
+        return json_cache.set('admins', address, admins)
+    
+    admins = get_wiki_admins(address, useCache = useCache)
+    # Current time, not the one from siteinfo - info is cached for days
+    cutoff = (datetime.datetime.utcnow() - datetime.timedelta(days = config['admin_active_days'])).strftime('%Y-%m-%dT%H:%M:%SZ')
+    
+    names = [admin['name'] for admin in admins if admin['editcount'] != 0]
+    active_names = set()
+    for i in range(0, len(names), 50):
+        remaining = names[i:i+50]
+        # Users are dropped from the query as soon as one edit newer than cutoff is found for them
+        # Rows are ordered by user, so the rest is queried again from the start instead of continuing
+        while remaining:
+            url = 'http://%s.wikia.com/api.php?action=query&list=usercontribs&uclimit=max&ucprop=timestamp&ucend=%s&ucuser=%s&format=json' % (address, cutoff, '|'.join([urllib2.quote(name.encode('utf-8')) for name in remaining]))
+            data = json_from_url(url)
+            contribs = data['query']['usercontribs']
+            for contrib in contribs:
+                active_names.add(contrib['user'])
+            if not contribs or ('query-continue' not in data and 'continue' not in data): break
+            remaining = [name for name in remaining if name not in active_names]
+    
+    activeadmins = [admin for admin in admins if admin['name'] in active_names]
+    return json_cache.set('active', address, activeadmins)
+def json_query_all(url, key):
+    items = []
+    cont = ''
+    while True:
+        data = json_from_url(url + cont, revalidate = True)
+        items.extend(data['query'][key])
+        if 'query-continue' in data: params = data['query-continue'][key]
+        elif 'continue' in data: params = data['continue']
+        else: return items
+        cont = ''.join(['&%s=%s' % (k, urllib2.quote(unicode(v).encode('utf-8'))) for k, v in params.items()])
+def get_wiki_last_change(address):
+    # Timestamp of the newest entry in recent changes - None if there's none
+    global args
+    if args['extended']: pywikibot.output(u'JSON: Checking recent changes for [%s]' % address)
+    url = 'http://%s.wikia.com/api.php?action=query&list=recentchanges&rcprop=timestamp&rclimit=1&format=json' % address
+    changes = json_from_url(url)['query']['recentchanges']
+    if changes: return changes[0]['timestamp']
+    return None
+def get_wikia_code(info, address):
+    match = re.compile('http:\/\/(www\.)?(.*?)\.wikia\.com', re.I).search(info['server'])
+    try: return match.group(2).strip()
+    except AttributeError: return address.strip()
+def get_wiki_siteinfo(address):
+    # General info and statistics always come from one siteinfo request per wiki and run
+    global flights
+    return flights.do((address, 'siteinfo'), lambda: fetch_wiki_siteinfo(address))
+def fetch_wiki_siteinfo(address):
     global json_cache, args
-    if useCache and address in json_cache['info']: return json_cache['info'][address]
-    if args['extended']: pywikibot.output('JSON: Fetching info about [%s]' % address)
-    url = 'http://%s.wikia.com/api.php?action=query&meta=siteinfo&siprop=general&format=json' % address
-    json_cache['info'][address] = json_from_url(url)['query']['general']
-    match = re.compile('http:\/\/(www\.)?(.*?)\.wikia\.com', re.I).search(json_cache['info'][address]['server'])
-    try: json_cache['info'][address]['wikia_code'] = match.group(2).strip()
-    except AttributeError: json_cache['info'][address]['wikia_code'] = address.strip()
-    return json_cache['info'][address]
+    if args['extended']: pywikibot.output(u'JSON: Fetching info and statistics for [%s]' % address)
+    url = 'http://%s.wikia.com/api.php?action=query&meta=siteinfo&siprop=general|statistics|variables&format=json' % address
+    data = json_from_url(url)['query']
+    info = pick(data['general'], siteinfo_fields['general'])
+    info['wikia_code'] = get_wikia_code(info, address)
+    city_id = get_city_id(data)
+    if city_id != None: json_cache.set('ids', address, city_id)
+    return {
+        'info': json_cache.set('info', address, info),
+        'stats': json_cache.set('stats', address, pick(data['statistics'], siteinfo_fields['statistics'])),
+    }
+def get_city_id(data):
+    # Numeric wiki id taken by the central API - general.wikiid is the database name, not this one
+    for var in data.get('variables', []):
+        if var.get('id') != 'wgCityId': continue
+        try: return int(var.get('*'))
+        except (TypeError, ValueError): return None
+    return None
+def pick(obj, keys):
+    return dict([(key, obj[key]) for key in keys if key in obj])
+# Only these fields of siteinfo and user lists are used - the rest isn't kept in the cache
+siteinfo_fields = {
+    'general': ['sitename', 'server', 'lang'],
+    'statistics': ['articles', 'images', 'activeusers'],
+    'user': ['name', 'editcount'],
+}
+def get_wiki_info(address, useCache=True):
+    global json_cache
+    if useCache:
+        info = json_cache.get('info', address, refresh = lambda: get_wiki_siteinfo(address))
+        if info != None: return info
+    return get_wiki_siteinfo(address)['info']
 def get_wiki_stats(address, useCache=True):
-    global json_cache, args
-    if useCache and address in json_cache['stats']: return json_cache['stats'][address]
-    if args['extended']: pywikibot.output(u'JSON: Fetching statistics for [%s]' % address)
-    url = 'http://%s.wikia.com/api.php?action=query&meta=siteinfo&siprop=statistics&format=json' % address
-    json_cache['stats'][address] = json_from_url(url)['query']['statistics']
-    return json_cache['stats'][address]
+    global json_cache, stats_backend
+    if useCache:
+        stats = json_cache.get('stats', address, refresh = lambda: stats_backend.statinfo(address))
+        if stats != None: return stats
+    return stats_backend.statinfo(address)['stats']
 def get_wiki_statinfo(address, useCache=True):
-    global json_cache, args
-    if useCache and address in json_cache['stats']: stats = json_cache['stats'][address]
-    else: stats = None
-    if useCache and address in json_cache['info']: info = json_cache['info'][address]
-    else: info = None
-    if stats == None and info == None:
-        if args['extended']: pywikibot.output(u'JSON: Fetching info and statistics for [%s]' % address)
-        url = 'http://%s.wikia.com/api.php?action=query&meta=siteinfo&siprop=general|statistics&format=json' % address
-        data = json_from_url(url)['query']
-        json_cache['stats'][address] = data['statistics']
-        json_cache['info'][address] = data['general']
-    elif stats == None: stats = get_wiki_stats(address)
-    elif info == None: info = get_wiki_info(address)
-    
-    match = re.compile('http:\/\/(www\.)?(.*?)\.wikia\.com', re.I).search(json_cache['info'][address]['server'])
-    try: json_cache['info'][address]['wikia_code'] = match.group(2).strip()
-    except AttributeError: json_cache['info'][address]['wikia_code'] = address.strip()
-    return {'info':json_cache['info'][address],'stats':json_cache['stats'][address]}
+    global json_cache, stats_backend
+    if useCache:
+        stats = json_cache.get('stats', address, refresh = lambda: stats_backend.statinfo(address))
+        info = json_cache.get('info', address, refresh = lambda: get_wiki_siteinfo(address))
+        if stats != None and info != None: return {'info':info,'stats':stats}
+    return stats_backend.statinfo(address)
+def page_exists(page):
+    global page_store
+    if page_store.known(page): return page_store.get(page) != None
+    return page.exists()
+def page_text(page, revid = None):
+    # Latest text (or the one of revid) from the page store, read from the wiki when it wasn't preloaded
+    global page_store
+    rev = page_store.get(page)
+    if rev != None and (revid == None or revid == rev[0]): return rev[2]
+    if revid == None: revid = page.latestRevision()
+    return page.getOldVersion(revid)
+def site_key(name):
+    global force_family, force_lang
+    return '%s:%s:%s' % (force_family, force_lang, name)
+def page_key(page):
+    return site_key(page.title())
 def get_config(page):
-    global site, config
+    # With the persistent cache settings are only downloaded again when the page has a new revision
+    global site, config, args
     page = pywikibot.Page(site, page)
     pywikibot.output('\03{lightyellow}Processing settings page:\03{default} \03{lightaqua}%s\03{default}' % page.title())
-    if not page.exists():
+    
+    revid = None
+    if args['cache']:
+        path = os.path.join(args['cache'], 'settings.json')
+        key = page_key(page)
+        revid = latest_revid(page)
+        if revid == None:
+            pywikibot.output("Page doesn't exist")
+            return
+        try:
+            f = open(path)
+            try: cached = json.load(f)
+            finally: f.close()
+        except (IOError, ValueError): cached = {}
+        if cached.get('key') == key and cached.get('revid') == revid:
+            pywikibot.output('Using cached settings from revision \03{lightgreen}#%d\03{default}' % revid)
+            tree_update(config, cached['settings'])
+            return
+    elif not page.exists():
         pywikibot.output("Page doesn't exist")
         return
-    page.permalink()
-    text = page.getOldVersion(page.latestRevision())
+    
+    if revid == None:
+        page.permalink()
+        revid = page.latestRevision()
+    text = page.getOldVersion(revid)
     text = pywikibot.replaceExcept(text, '< */? *(pre|source).*?>','',[])
     
     decoded = json.loads(text);
     
+    if args['cache']:
+        if not os.path.isdir(args['cache']): os.makedirs(args['cache'])
+        f = open(path + '.tmp', 'w')
+        try: json.dump({'key': key, 'revid': revid, 'settings': decoded}, f)
+        finally: f.close()
+        if os.path.exists(path): os.remove(path)
+        os.rename(path + '.tmp', path)
+    
     tree_update(config,decoded)
 def print_config(config, name, indent = ''):
     typ = type(config).__name__